@@ -18,3 +18,8 @@ KEY_MISTRAL = environ.get("KEY_MISTRAL", "")
 
 # API key for deepseek. Needed only for benchmarking.
 KEY_DEEPSEEK = environ.get("KEY_DEEPSEEK", "")
+
+# Base urls of the OpenAI and DeepSeek APIs. Point them to any OpenAI-compatible server,
+# like a local stub in tests. None for the OpenAI default.
+URL_OPENAI = environ.get("URL_OPENAI") or None
+URL_DEEPSEEK = environ.get("URL_DEEPSEEK", "https://api.deepseek.com")
@@ -1,25 +1,41 @@
 from logging import getLogger
-from time import sleep
-from typing import Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional
 
-from anthropic import Anthropic, RateLimitError
+from anthropic import (
+    APIConnectionError,
+    Anthropic,
+    AsyncAnthropic,
+    InternalServerError,
+    RateLimitError,
+)
+from anthropic.types import Message
 
 from medask.const import KEY_ANTHROPIC
 from medask.models.comms.models import CMessage
 from medask.models.orm.models import Role
+from medask.util.concurrency import per_loop
 from medask.util.decorator import timeit
 from medask.util.gen_cmsg import gen_cmsg
+from medask.util.rate_limit import estimate_tokens, get_rate_limiter
 from medask.ummon.base import BaseUmmon
 
-client = Anthropic(api_key=KEY_ANTHROPIC)
+# Retries are left to the shared rate limiter, which sees every 429.
+client = Anthropic(api_key=KEY_ANTHROPIC, max_retries=0)
+aclient = per_loop(lambda: AsyncAnthropic(api_key=KEY_ANTHROPIC, max_retries=0))
 logger = getLogger("ummon.anthropic")
 
 
+def _is_rate_limit(e: Exception) -> bool:
+    # Also the connection errors and 5xx the SDK would retry, as the rate limiter owns retries.
+    return isinstance(e, (RateLimitError, APIConnectionError, InternalServerError))
+
+
 class UmmonAnthropic(BaseUmmon):
     def __init__(self, model: Optional[str] = None) -> None:
         self._model = model or "claude-3-haiku-20240307"
+        self._limiter = get_rate_limiter("anthropic", self._model)
 
-    def _converse_raw(self, history: List[Dict[str, str]]) -> str:
+    def _params(self, history: List[Dict[str, str]]) -> Dict[str, Any]:
         params = dict(
             model=self._model,
             messages=history,
@@ -30,20 +46,50 @@ class UmmonAnthropic(BaseUmmon):
         if len(history) > 1 and history[0]["role"] == "system":
             params["system"] = history[0]["content"]
             params["messages"] = history[1:]
+        return params
 
-        slep = 3.0
-        while slep < 60:
-            try:
-                out = client.messages.create(**params)
-                if out.stop_reason == "max_tokens":
-                    logger.warning(f"Max tokens reached at {out}")
-                return out.content[0].text
-            except RateLimitError:
-                logger.info(f"Rate limit, sleeping for {round(slep, 1)} seconds.")
-                sleep(slep)
-                slep *= 1.5
+    def _parse(self, out: Message, tokens: int) -> str:
+        if out.stop_reason == "max_tokens":
+            logger.warning(f"Max tokens reached at {out}")
+        self._limiter.settle(tokens, out.usage.input_tokens + out.usage.output_tokens)
+        return out.content[0].text
+
+    def _converse_raw(self, history: List[Dict[str, str]]) -> str:
+        params = self._params(history)
+        tokens = estimate_tokens(history, max_output=params["max_tokens"])
+        raw = self._limiter.call(
+            lambda: client.messages.with_raw_response.create(**params), tokens, _is_rate_limit
+        )
+        return self._parse(raw.parse(), tokens)
+
+    async def _aconverse_raw(self, history: List[Dict[str, str]]) -> str:
+        params = self._params(history)
+        tokens = estimate_tokens(history, max_output=params["max_tokens"])
+        raw = await self._limiter.acall(
+            lambda: aclient().messages.with_raw_response.create(**params), tokens, _is_rate_limit
+        )
+        return self._parse(raw.parse(), tokens)
+
+    async def _astream_raw(self, history: List[CMessage]) -> AsyncIterator[str]:
+        history_raw = [msg.to_anthropic() for msg in history]
+        params = self._params(history_raw)
+        params["stream"] = True
+        tokens = estimate_tokens(history_raw, max_output=params["max_tokens"])
 
-        raise RuntimeError("Too much rate limiting")
+        def open_stream():
+            return aclient().messages.create(**params)
+
+        streamed = 0
+        async with self._limiter.astream(open_stream, tokens, _is_rate_limit) as stream:
+            try:
+                async for event in stream:
+                    if event.type == "content_block_delta" and event.delta.type == "text_delta":
+                        streamed += len(event.delta.text)
+                        yield event.delta.text
+            finally:
+                self._limiter.settle(tokens, estimate_tokens(history_raw, streamed // 4))
+                # Closing the connection early cancels the rest of the generation.
+                await stream.close()
 
     @timeit(logger, log_kwargs=False)
     def inquire(self, prompt: CMessage, json: bool = False) -> CMessage:
@@ -57,3 +103,16 @@ class UmmonAnthropic(BaseUmmon):
         retort: str = self._converse_raw(history_raw)
 
         return gen_cmsg(history[-1], body=retort, role=Role.ASSISTANT)
+
+    @timeit(logger, log_kwargs=False)
+    async def ainquire(self, prompt: CMessage, json: bool = False) -> CMessage:
+        prompt_raw = prompt.to_anthropic()
+        retort: str = await self._aconverse_raw([prompt_raw])
+        return gen_cmsg(prompt, body=retort, role=Role.ASSISTANT)
+
+    @timeit(logger, log_kwargs=False)
+    async def aconverse(self, history: List[CMessage]) -> CMessage:
+        history_raw = [msg.to_anthropic() for msg in history]
+        retort: str = await self._aconverse_raw(history_raw)
+
+        return gen_cmsg(history[-1], body=retort, role=Role.ASSISTANT)
@@ -1,10 +1,15 @@
 from abc import abstractmethod, ABC
-from typing import List
+from typing import AsyncIterator, Callable, List, Optional
 
 from medask.models.comms.models import CMessage
+from medask.models.orm.models import Role
+from medask.util.gen_cmsg import gen_cmsg
 
 
 class BaseUmmon(ABC):
+    # Sampling temperature sent with each request, None for the provider's default.
+    temperature: Optional[float] = None
+
     @abstractmethod
     def inquire(self, prompt: CMessage) -> CMessage:
         pass
@@ -12,3 +17,44 @@ class BaseUmmon(ABC):
     @abstractmethod
     def converse(self, history: List[CMessage]) -> CMessage:
         pass
+
+    @abstractmethod
+    async def ainquire(self, prompt: CMessage) -> CMessage:
+        pass
+
+    @abstractmethod
+    async def aconverse(self, history: List[CMessage]) -> CMessage:
+        pass
+
+    async def _astream_raw(self, history: List[CMessage]) -> AsyncIterator[str]:
+        """
+        Yield chunks of the reply to <history> as they are generated. Clients supporting
+        streaming override this, the rest yield the whole reply at once.
+        """
+        yield (await self.aconverse(history)).body
+
+    async def astream(
+        self, history: List[CMessage], stop: Optional[Callable[[str], bool]] = None
+    ) -> AsyncIterator[str]:
+        """
+        Yield chunks of the reply to <history> as they are generated.
+        :param stop: Called with the reply so far after each chunk. Once it returns True,
+            the generation is cancelled, saving the latency and tokens of the rest.
+        """
+        text = ""
+        chunks = self._astream_raw(history)
+        try:
+            async for chunk in chunks:
+                text += chunk
+                yield chunk
+                if stop is not None and stop(text):
+                    break
+        finally:
+            await chunks.aclose()
+
+    async def aconverse_until(
+        self, history: List[CMessage], stop: Callable[[str], bool]
+    ) -> CMessage:
+        """Same as self.aconverse(), but the reply is cut short once <stop>(reply) is True."""
+        text = "".join([chunk async for chunk in self.astream(history, stop)])
+        return gen_cmsg(history[-1], body=text, role=Role.ASSISTANT)
@@ -0,0 +1,111 @@
+import hashlib
+import json as jsonlib
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from medask.models.comms.models import CMessage
+from medask.models.orm.models import Role
+from medask.util.cache import SqliteCache
+from medask.util.gen_cmsg import gen_cmsg
+from medask.ummon.base import BaseUmmon
+
+
+class UmmonCached(BaseUmmon):
+    """
+    Wrap <ummon> so its completions are stored in <cache> and not paid for twice.
+    Completions are keyed on the provider, model, temperature, json flag and the normalized
+    message history.
+    :param namespace: Also part of the key. Repeated samples of the same prompt, like the
+        experiments of a benchmark, should each get their own namespace, otherwise they'd
+        all get the first completion.
+    """
+
+    def __init__(self, ummon: BaseUmmon, cache: SqliteCache, namespace: str = "") -> None:
+        self.ummon = ummon
+        self.temperature = ummon.temperature
+        self._cache = cache
+        self._namespace = namespace
+        self._model = ummon._model
+
+    def _key(
+        self,
+        history: List[CMessage],
+        json: bool,
+        stream: bool = False,
+        labels: Optional[List[str]] = None,
+    ) -> str:
+        payload = {
+            "provider": type(self.ummon).__name__,
+            "model": self._model,
+            "temperature": self.temperature,
+            "json": json,
+            # Streamed replies may have been stopped early, so they're not full replies.
+            "stream": stream,
+            "namespace": self._namespace,
+            # Ids and other metadata don't influence the completion, only roles and bodies do.
+            "messages": [[msg.role.value, msg.body.strip()] for msg in history],
+        }
+        if labels is not None:
+            # Label distributions are cached apart from the completions of the same prompt.
+            payload["labels"] = labels
+        raw = jsonlib.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _kwargs(self, json: bool) -> Dict[str, Any]:
+        # Not every client takes the json flag.
+        return {"json": True} if json else {}
+
+    def _lookup(self, history: List[CMessage], json: bool) -> Optional[CMessage]:
+        hit, body = self._cache.has_key(self._key(history, json))
+        if not hit:
+            return None
+        return gen_cmsg(history[-1], body=body, role=Role.ASSISTANT)
+
+    def _store(self, history: List[CMessage], json: bool, out: CMessage) -> CMessage:
+        self._cache.add({self._key(history, json): out.body})
+        return out
+
+    def inquire(self, prompt: CMessage, json: bool = False) -> CMessage:
+        if out := self._lookup([prompt], json):
+            return out
+        return self._store([prompt], json, self.ummon.inquire(prompt, **self._kwargs(json)))
+
+    def converse(self, history: List[CMessage], json: bool = False) -> CMessage:
+        if out := self._lookup(history, json):
+            return out
+        return self._store(history, json, self.ummon.converse(history, **self._kwargs(json)))
+
+    async def ainquire(self, prompt: CMessage, json: bool = False) -> CMessage:
+        if out := self._lookup([prompt], json):
+            return out
+        out = await self.ummon.ainquire(prompt, **self._kwargs(json))
+        return self._store([prompt], json, out)
+
+    async def aconverse(self, history: List[CMessage], json: bool = False) -> CMessage:
+        if out := self._lookup(history, json):
+            return out
+        out = await self.ummon.aconverse(history, **self._kwargs(json))
+        return self._store(history, json, out)
+
+    async def astream(
+        self, history: List[CMessage], stop: Optional[Callable[[str], bool]] = None
+    ) -> AsyncIterator[str]:
+        key = self._key(history, json=False, stream=True)
+        hit, body = self._cache.has_key(key)
+        if hit:
+            yield body
+            return
+
+        text = ""
+        async for chunk in self.ummon.astream(history, stop):
+            text += chunk
+            yield chunk
+        self._cache.add({key: text})
+
+    async def aclassify(self, prompt: CMessage, labels: List[str]) -> Dict[str, float]:
+        key = self._key([prompt], json=False, labels=labels)
+        hit, distribution = self._cache.has_key(key)
+        if hit:
+            return distribution
+        distribution = await self.ummon.aclassify(prompt, labels)
+        self._cache.add({key: distribution})
+        return distribution
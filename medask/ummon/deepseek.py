@@ -1,43 +1,95 @@
 from logging import getLogger
-from time import sleep
-from typing import Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional
 
-from openai import OpenAI, RateLimitError
+from openai import (
+    APIConnectionError,
+    AsyncOpenAI,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
 
-from medask.const import KEY_DEEPSEEK
+from medask.const import KEY_DEEPSEEK, URL_DEEPSEEK
 from medask.models.comms.models import CMessage
 from medask.models.orm.models import Role
+from medask.util.concurrency import per_loop
 from medask.util.decorator import timeit
 from medask.util.gen_cmsg import gen_cmsg
+from medask.util.logprobs import TOP_LOGPROBS, first_token_logprobs, label_distribution
+from medask.util.rate_limit import estimate_tokens, get_rate_limiter
 from medask.ummon.base import BaseUmmon
 
 logger = getLogger("ummon.deepseek")
-client = OpenAI(api_key=KEY_DEEPSEEK, timeout=60, base_url="https://api.deepseek.com")
+# Retries are left to the shared rate limiter, which sees every 429.
+client = OpenAI(api_key=KEY_DEEPSEEK, timeout=60, base_url=URL_DEEPSEEK, max_retries=0)
+aclient = per_loop(
+    lambda: AsyncOpenAI(api_key=KEY_DEEPSEEK, timeout=60, base_url=URL_DEEPSEEK, max_retries=0)
+)
+
+
+def _is_rate_limit(e: Exception) -> bool:
+    # Also the connection errors and 5xx the SDK would retry, as the rate limiter owns retries.
+    return isinstance(e, (RateLimitError, APIConnectionError, InternalServerError))
 
 
 class UmmonDeepSeek(BaseUmmon):
     def __init__(self, model: Optional[str] = None) -> None:
         self._model = model or "deepseek-chat"
+        self._limiter = get_rate_limiter("deepseek", self._model)
 
-    def _converse_raw(self, history: List[Dict[str, str]], json: bool) -> str:
+    def _params(self, history: List[Dict[str, str]], json: bool) -> Dict[str, Any]:
         params = dict(
             model=self._model,
             messages=history,
         )
         if json:
             params["response_format"] = {"type": "json_object"}
+        return params
 
-        slep = 3.0
-        while slep < 60:
-            try:
-                completion = client.chat.completions.create(**params)
-                return completion.choices[0].message.content
-            except RateLimitError:
-                logger.info(f"Rate limit, sleeping for {round(slep, 1)} seconds.")
-                sleep(slep)
-                slep *= 1.5
+    def _converse_raw(self, history: List[Dict[str, str]], json: bool) -> str:
+        params = self._params(history, json)
+        tokens = estimate_tokens(history)
+        raw = self._limiter.call(
+            lambda: client.chat.completions.with_raw_response.create(**params),
+            tokens,
+            _is_rate_limit,
+        )
+        completion = raw.parse()
+        self._limiter.settle(tokens, completion.usage and completion.usage.total_tokens)
+        return completion.choices[0].message.content
 
-        raise RuntimeError("Too much rate limiting")
+    async def _aconverse_raw(self, history: List[Dict[str, str]], json: bool) -> str:
+        params = self._params(history, json)
+        tokens = estimate_tokens(history)
+        raw = await self._limiter.acall(
+            lambda: aclient().chat.completions.with_raw_response.create(**params),
+            tokens,
+            _is_rate_limit,
+        )
+        completion = raw.parse()
+        self._limiter.settle(tokens, completion.usage and completion.usage.total_tokens)
+        return completion.choices[0].message.content
+
+    async def _astream_raw(self, history: List[CMessage]) -> AsyncIterator[str]:
+        history_raw = [msg.to_openai() for msg in history]
+        params = self._params(history_raw, json=False)
+        params["stream"] = True
+        tokens = estimate_tokens(history_raw)
+
+        def open_stream():
+            return aclient().chat.completions.create(**params)
+
+        streamed = 0
+        async with self._limiter.astream(open_stream, tokens, _is_rate_limit) as stream:
+            try:
+                async for chunk in stream:
+                    if chunk.choices and (delta := chunk.choices[0].delta.content):
+                        streamed += len(delta)
+                        yield delta
+            finally:
+                self._limiter.settle(tokens, estimate_tokens(history_raw, streamed // 4))
+                # Closing the connection early cancels the rest of the generation.
+                await stream.close()
 
     @timeit(logger, log_kwargs=False)
     def inquire(self, prompt: CMessage, json: bool = False) -> CMessage:
@@ -51,3 +103,34 @@ class UmmonDeepSeek(BaseUmmon):
         retort: str = self._converse_raw(history_raw, json=json)
 
         return gen_cmsg(history[-1], body=retort, role=Role.ASSISTANT)
+
+    @timeit(logger, log_kwargs=False)
+    async def ainquire(self, prompt: CMessage, json: bool = False) -> CMessage:
+        prompt_raw = prompt.to_openai()
+        retort: str = await self._aconverse_raw([prompt_raw], json=json)
+        return gen_cmsg(prompt, body=retort, role=Role.ASSISTANT)
+
+    @timeit(logger, log_kwargs=False)
+    async def aconverse(self, history: List[CMessage], json: bool = False) -> CMessage:
+        history_raw = [msg.to_openai() for msg in history]
+        retort: str = await self._aconverse_raw(history_raw, json=json)
+
+        return gen_cmsg(history[-1], body=retort, role=Role.ASSISTANT)
+
+    @timeit(logger, log_kwargs=False)
+    async def aclassify(self, prompt: CMessage, labels: List[str]) -> Dict[str, float]:
+        """
+        Probability of each of <labels> as the reply to <prompt>, from the top logprobs of a
+        single generated token. See label_distribution().
+        """
+        params = self._params([prompt.to_openai()], json=False)
+        params.update(max_tokens=1, logprobs=True, top_logprobs=TOP_LOGPROBS)
+        tokens = estimate_tokens(params["messages"], max_output=1)
+        raw = await self._limiter.acall(
+            lambda: aclient().chat.completions.with_raw_response.create(**params),
+            tokens,
+            _is_rate_limit,
+        )
+        completion = raw.parse()
+        self._limiter.settle(tokens, completion.usage and completion.usage.total_tokens)
+        return label_distribution(first_token_logprobs(completion), labels)
@@ -1,36 +1,74 @@
 import json
-from typing import Dict, List
+from typing import AsyncIterator, Dict, List
 
 from medask.models.comms.models import CMessage
 from medask.models.orm.models import Role
-from medask.util.client import post
+from medask.util.client import apost, astream_post, post
 from medask.util.decorator import timeit
 from medask.util.log import get_logger
+from medask.util.rate_limit import get_rate_limiter
 from medask.ummon.base import BaseUmmon
 
 logger = get_logger("ummon.koboldcpp")
 
 
+def _is_rate_limit(e: Exception) -> bool:
+    # A local server has no rate limits, its congestion only shows in the latency.
+    return False
+
+
 class UmmonKoboldCPP(BaseUmmon):
+    temperature = 0.3
+
     def __init__(self, model: str) -> None:
         """Note, model is actually an url to the server."""
         # Example url: http://localhost:5013.
         assert "http" in model, f"param model should point to the server, not {model}"
         self._url = model
         self._model = model  # hack for benchmark.
+        self._limiter = get_rate_limiter("koboldcpp", self._url)
 
-    def _converse_raw(self, history: List[Dict[str, str]]) -> str:
-        body = json.dumps(
+    def _body(self, history: List[Dict[str, str]], stream: bool = False) -> str:
+        return json.dumps(
             {
                 "messages": history,
-                "temperature": 0.3,
+                "temperature": self.temperature,
                 "max_tokens": 300,
+                "stream": stream,
             }
         )
-        resp = post("v1/chat/completions", body=body, url=self._url)
+
+    def _converse_raw(self, history: List[Dict[str, str]]) -> str:
+        body = self._body(history)
+        resp = self._limiter.call(
+            lambda: post("v1/chat/completions", body=body, url=self._url), 0, _is_rate_limit
+        )
+        resp = resp["choices"][0]["message"]["content"]
+        return resp
+
+    async def _aconverse_raw(self, history: List[Dict[str, str]]) -> str:
+        body = self._body(history)
+        resp = await self._limiter.acall(
+            lambda: apost("v1/chat/completions", body=body, url=self._url), 0, _is_rate_limit
+        )
         resp = resp["choices"][0]["message"]["content"]
         return resp
 
+    async def _astream_raw(self, history: List[CMessage]) -> AsyncIterator[str]:
+        body = self._body([msg.to_openai() for msg in history], stream=True)
+
+        async def open_stream() -> AsyncIterator[Dict]:
+            return astream_post("v1/chat/completions", body=body, url=self._url)
+
+        async with self._limiter.astream(open_stream, 0, _is_rate_limit) as events:
+            try:
+                async for event in events:
+                    if delta := event["choices"][0]["delta"].get("content"):
+                        yield delta
+            finally:
+                # Closing the connection early cancels the rest of the generation.
+                await events.aclose()
+
     def _raw_to_out(self, user_id: int, chat_id: int, raw: str) -> CMessage:
         return CMessage(
             user_id=user_id,
@@ -52,3 +90,17 @@ class UmmonKoboldCPP(BaseUmmon):
 
         msg = history[-1]
         return self._raw_to_out(msg.user_id, msg.chat_id, retort)
+
+    @timeit(logger, log_kwargs=False)
+    async def ainquire(self, prompt: CMessage) -> CMessage:
+        prompt_raw = prompt.to_openai()
+        retort: str = await self._aconverse_raw([prompt_raw])
+        return self._raw_to_out(prompt.user_id, prompt.chat_id, retort)
+
+    @timeit(logger, log_kwargs=False)
+    async def aconverse(self, history: List[CMessage]) -> CMessage:
+        history_raw = [msg.to_openai() for msg in history]
+        retort: str = await self._aconverse_raw(history_raw)
+
+        msg = history[-1]
+        return self._raw_to_out(msg.user_id, msg.chat_id, retort)
@@ -3,14 +3,20 @@ from typing import Dict, List
 
 from medask.models.comms.models import CMessage
 from medask.models.orm.models import Role
-from medask.util.client import post
+from medask.util.client import apost, post
 from medask.util.decorator import timeit
 from medask.util.log import get_logger
+from medask.util.rate_limit import get_rate_limiter
 from medask.ummon.base import BaseUmmon
 
 logger = get_logger("UmmonLocalLLM")
 
 
+def _is_rate_limit(e: Exception) -> bool:
+    # A local server has no rate limits, its congestion only shows in the latency.
+    return False
+
+
 class UmmonLocalLLM(BaseUmmon):
     def __init__(self, model: str) -> None:
         """Note, model is actually an url to the server."""
@@ -18,11 +24,22 @@ class UmmonLocalLLM(BaseUmmon):
         assert "http" in model, f"param model should point to the server, not {model}"
         self._url = model
         self._model = model  # hack for benchmark.
+        self._limiter = get_rate_limiter("local", self._url)
 
     def _converse_raw(self, history: List[Dict[str, str]]) -> str:
         assert len(history) == 1, "Other things unsupported for now"
         body = json.dumps(history[0])
-        resp = post("inquire", body=body, url=self._url)
+        resp = self._limiter.call(
+            lambda: post("inquire", body=body, url=self._url), 0, _is_rate_limit
+        )
+        return resp
+
+    async def _aconverse_raw(self, history: List[Dict[str, str]]) -> str:
+        assert len(history) == 1, "Other things unsupported for now"
+        body = json.dumps(history[0])
+        resp = await self._limiter.acall(
+            lambda: apost("inquire", body=body, url=self._url), 0, _is_rate_limit
+        )
         return resp
 
     def _raw_to_out(self, user_id: int, chat_id: int, raw: str) -> CMessage:
@@ -46,3 +63,17 @@ class UmmonLocalLLM(BaseUmmon):
 
         msg = history[-1]
         return self._raw_to_out(msg.user_id, msg.chat_id, retort)
+
+    @timeit(logger, log_kwargs=False)
+    async def ainquire(self, prompt: CMessage) -> CMessage:
+        prompt_raw = prompt.to_openai()
+        retort: str = await self._aconverse_raw([prompt_raw])
+        return self._raw_to_out(prompt.user_id, prompt.chat_id, retort)
+
+    @timeit(logger, log_kwargs=False)
+    async def aconverse(self, history: List[CMessage]) -> CMessage:
+        history_raw = [msg.to_openai() for msg in history]
+        retort: str = await self._aconverse_raw(history_raw)
+
+        msg = history[-1]
+        return self._raw_to_out(msg.user_id, msg.chat_id, retort)
@@ -1,44 +1,77 @@
 from logging import getLogger
-from time import sleep
-from typing import Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional
 
 from mistralai import Mistral
+from mistralai.models import SDKError
 
 from medask.const import KEY_MISTRAL
 from medask.models.comms.models import CMessage
 from medask.models.orm.models import Role
+from medask.util.concurrency import per_loop
 from medask.util.decorator import timeit
 from medask.util.gen_cmsg import gen_cmsg
+from medask.util.rate_limit import estimate_tokens, get_rate_limiter
 from medask.ummon.base import BaseUmmon
 
 logger = getLogger("ummon.mistral")
 client = Mistral(api_key=KEY_MISTRAL)
+aclient = per_loop(lambda: Mistral(api_key=KEY_MISTRAL))
+
+
+def _is_rate_limit(e: Exception) -> bool:
+    return isinstance(e, SDKError) and e.status_code == 429
 
 
 class UmmonMistral(BaseUmmon):
     def __init__(self, model: Optional[str] = None) -> None:
         self._model = model or "open-mixtral-8x7b"
+        self._limiter = get_rate_limiter("mistral", self._model)
 
-    def _converse_raw(self, history: List[Dict[str, str]], json: bool = False) -> str:
+    def _params(self, history: List[Dict[str, str]], json: bool) -> Dict[str, Any]:
         params = dict(
             model=self._model,
             messages=history,
         )
         if json:
             params["response_format"] = {"type": "json_object"}
+        return params
 
-        slep = 3.0
-        while slep < 60:
-            try:
-                completion = client.chat.complete(**params)
-                return completion.choices[0].message.content
-            # TODO handle rate limiting
-            except ValueError:
-                logger.info(f"Rate limit, sleeping for {round(slep, 1)} seconds.")
-                sleep(slep)
-                slep *= 1.5
+    def _converse_raw(self, history: List[Dict[str, str]], json: bool = False) -> str:
+        params = self._params(history, json)
+        tokens = estimate_tokens(history)
+        completion = self._limiter.call(
+            lambda: client.chat.complete(**params), tokens, _is_rate_limit
+        )
+        self._limiter.settle(tokens, completion.usage.total_tokens)
+        return completion.choices[0].message.content
 
-        raise RuntimeError("Too much rate limiting")
+    async def _aconverse_raw(self, history: List[Dict[str, str]], json: bool = False) -> str:
+        params = self._params(history, json)
+        tokens = estimate_tokens(history)
+        completion = await self._limiter.acall(
+            lambda: aclient().chat.complete_async(**params), tokens, _is_rate_limit
+        )
+        self._limiter.settle(tokens, completion.usage.total_tokens)
+        return completion.choices[0].message.content
+
+    async def _astream_raw(self, history: List[CMessage]) -> AsyncIterator[str]:
+        history_raw = [msg.to_openai() for msg in history]
+        params = self._params(history_raw, json=False)
+        tokens = estimate_tokens(history_raw)
+
+        def open_stream():
+            return aclient().chat.stream_async(**params)
+
+        streamed = 0
+        async with self._limiter.astream(open_stream, tokens, _is_rate_limit) as stream:
+            try:
+                async for event in stream:
+                    if event.data.choices and (delta := event.data.choices[0].delta.content):
+                        streamed += len(delta)
+                        yield delta
+            finally:
+                self._limiter.settle(tokens, estimate_tokens(history_raw, streamed // 4))
+                await stream.aclose()
 
     @timeit(logger, log_kwargs=False)
     def inquire(self, prompt: CMessage, json: bool = False) -> CMessage:
@@ -52,3 +85,16 @@ class UmmonMistral(BaseUmmon):
         retort: str = self._converse_raw(history_raw, json=json)
 
         return gen_cmsg(history[-1], body=retort, role=Role.ASSISTANT)
+
+    @timeit(logger, log_kwargs=False)
+    async def ainquire(self, prompt: CMessage, json: bool = False) -> CMessage:
+        prompt_raw = prompt.to_openai()
+        retort: str = await self._aconverse_raw([prompt_raw], json=json)
+        return gen_cmsg(prompt, body=retort, role=Role.ASSISTANT)
+
+    @timeit(logger, log_kwargs=False)
+    async def aconverse(self, history: List[CMessage], json: bool = False) -> CMessage:
+        history_raw = [msg.to_openai() for msg in history]
+        retort: str = await self._aconverse_raw(history_raw, json=json)
+
+        return gen_cmsg(history[-1], body=retort, role=Role.ASSISTANT)
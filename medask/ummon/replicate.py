@@ -1,28 +1,36 @@
 from logging import getLogger
-from time import sleep
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 
 from replicate import Client
+from replicate.exceptions import ReplicateError
 
 from medask.const import KEY_REPLICATE
 from medask.models.comms.models import CMessage
 from medask.models.orm.models import Role
+from medask.util.concurrency import per_loop
 from medask.util.decorator import timeit
 from medask.util.gen_cmsg import gen_cmsg
+from medask.util.rate_limit import estimate_tokens, get_rate_limiter
 from medask.ummon.base import BaseUmmon
 
 client = Client(api_token=KEY_REPLICATE)
+aclient = per_loop(lambda: Client(api_token=KEY_REPLICATE))
 logger = getLogger("ummon.replicate")
 
 
+def _is_rate_limit(e: Exception) -> bool:
+    return isinstance(e, ReplicateError) and e.status == 429
+
+
 class UmmonReplicate(BaseUmmon):
     def __init__(self, model: Optional[str] = None) -> None:
         self._model = model or "mistralai/mixtral-8x7b-instruct-v0.1"
+        self._limiter = get_rate_limiter("replicate", self._model)
         # I think generating a prediction over multplie input messages isn't supported,
         # so this client is not (yet) available.
         raise RuntimeError("Client not yet supported.")
 
-    def _converse_raw(self, history: List[Dict[str, str]]) -> str:
+    def _params(self, history: List[Dict[str, str]]) -> Dict[str, Any]:
         params = dict(
             messages=history,
             max_tokens=1000,
@@ -32,21 +40,25 @@ class UmmonReplicate(BaseUmmon):
         if len(history) > 1 and history[0]["role"] == "system":
             params["system"] = history[0]["content"]
             params["messages"] = history[1:]
+        return params
+
+    def _converse_raw(self, history: List[Dict[str, str]]) -> str:
+        params = self._params(history)
+        tokens = estimate_tokens(history, max_output=params["max_tokens"])
+        out = self._limiter.call(lambda: client.run(self._model, **params), tokens, _is_rate_limit)
+        if out.stop_reason == "max_tokens":
+            logger.warning(f"Max tokens reached at {out}")
+        return out.content[0].text
 
-        slep = 3.0
-        while slep < 60:
-            try:
-                out = client.run(self._model, **params)
-                if out.stop_reason == "max_tokens":
-                    logger.warning(f"Max tokens reached at {out}")
-                return out.content[0].text
-            # TODO add rate limit handling
-            except ValueError:
-                logger.info(f"Rate limit, sleeping for {round(slep, 1)} seconds.")
-                sleep(slep)
-                slep *= 1.5
-
-        raise RuntimeError("Too much rate limiting")
+    async def _aconverse_raw(self, history: List[Dict[str, str]]) -> str:
+        params = self._params(history)
+        tokens = estimate_tokens(history, max_output=params["max_tokens"])
+        out = await self._limiter.acall(
+            lambda: aclient().async_run(self._model, **params), tokens, _is_rate_limit
+        )
+        if out.stop_reason == "max_tokens":
+            logger.warning(f"Max tokens reached at {out}")
+        return out.content[0].text
 
     @timeit(logger, log_kwargs=False)
     def inquire(self, prompt: CMessage, json: bool = False) -> CMessage:
@@ -60,3 +72,16 @@ class UmmonReplicate(BaseUmmon):
         retort: str = self._converse_raw(history_raw)
 
         return gen_cmsg(history[-1], body=retort, role=Role.ASSISTANT)
+
+    @timeit(logger, log_kwargs=False)
+    async def ainquire(self, prompt: CMessage, json: bool = False) -> CMessage:
+        prompt_raw = prompt.to_anthropic()
+        retort: str = await self._aconverse_raw([prompt_raw])
+        return gen_cmsg(prompt, body=retort, role=Role.ASSISTANT)
+
+    @timeit(logger, log_kwargs=False)
+    async def aconverse(self, history: List[CMessage]) -> CMessage:
+        history_raw = [msg.to_anthropic() for msg in history]
+        retort: str = await self._aconverse_raw(history_raw)
+
+        return gen_cmsg(history[-1], body=retort, role=Role.ASSISTANT)
@@ -0,0 +1,137 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Point estimate, lower and upper bound of a confidence interval.
+Interval = Tuple[float, float, float]
+
+# Cells of the resampling matrices built at once, which bounds memory at ~80MB.
+_CHUNK_CELLS = 10_000_000
+
+
+def cluster_totals(values: Any, clusters: Optional[Sequence] = None) -> np.ndarray:
+    """
+    Sum the rows of <values>, (statistics × n), over each cluster of <clusters>, n labels
+    like vignette ids. Without clusters every column is its own cluster.
+    :return: Totals of shape (statistics × clusters).
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    if clusters is None:
+        return values
+    _, inverse = np.unique(np.asarray(clusters), return_inverse=True)
+    n_clusters = inverse.max() + 1 if len(inverse) else 0
+    return np.stack([np.bincount(inverse, weights=row, minlength=n_clusters) for row in values])
+
+
+def _resampled_totals(totals: np.ndarray, n_resamples: int, seed: Any) -> np.ndarray:
+    """Totals of <n_resamples> resamples of the clusters (columns) of <totals>."""
+    rng = np.random.default_rng(seed)
+    n_clusters = totals.shape[1]
+    chunk = max(1, _CHUNK_CELLS // max(n_clusters, 1))
+    out = []
+    for start in range(0, n_resamples, chunk):
+        size = min(chunk, n_resamples - start)
+        # Index matrix of the clusters drawn by each resample, turned into draw counts.
+        idx = rng.integers(0, n_clusters, size=(size, n_clusters))
+        idx += n_clusters * np.arange(size)[:, None]
+        counts = np.bincount(idx.ravel(), minlength=size * n_clusters).reshape(size, n_clusters)
+        out.append(counts @ totals.T)
+    return np.concatenate(out) if out else np.empty((0, totals.shape[0]))
+
+
+def resample_totals(
+    totals: np.ndarray, n_resamples: int = 10_000, seed: int = 0, workers: int = 1
+) -> np.ndarray:
+    """
+    Bootstrap the clusters of <totals>, (statistics × clusters), with replacement.
+    :param workers: Split the resamples over that many processes, for very large sweeps.
+    :return: Totals of each statistic in each resample, (n_resamples × statistics).
+    """
+    if workers <= 1:
+        return _resampled_totals(totals, n_resamples, seed)
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    sizes = [n_resamples // workers + (i < n_resamples % workers) for i in range(workers)]
+    with ProcessPoolExecutor(workers) as pool:
+        parts = pool.map(_resampled_totals, [totals] * workers, sizes, seeds)
+        return np.concatenate(list(parts))
+
+
+def _interval(estimate: float, samples: np.ndarray, confidence: float) -> Interval:
+    alpha = (1 - confidence) / 2
+    samples = samples[~np.isnan(samples)]
+    if not len(samples):
+        return estimate, float("nan"), float("nan")
+    low, high = np.percentile(samples, [100 * alpha, 100 * (1 - alpha)])
+    return estimate, float(low), float(high)
+
+
+def _ratio(num: Any, den: Any) -> Any:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.divide(num, den)
+
+
+def bootstrap_ratios(
+    nums: Any,
+    dens: Any = None,
+    clusters: Optional[Sequence] = None,
+    n_resamples: int = 10_000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    workers: int = 1,
+) -> List[Interval]:
+    """
+    Percentile bootstrap confidence intervals of the ratios sum(nums[i]) / sum(dens[i]),
+    like accuracy (correct / 1) or over-triage rate (over-triaged / incorrect). Rows are
+    resampled by cluster, so the runs of a vignette are pooled and drawn together, and all
+    ratios share the same resamples.
+    :param nums: Numerators, (statistics × n) or (n,).
+    :param dens: Denominators of the same shape, by default 1 for every row.
+    :param clusters: Cluster of each of the n rows, by default each row on its own.
+    """
+    nums = np.atleast_2d(np.asarray(nums, dtype=float))
+    dens = np.ones_like(nums) if dens is None else np.atleast_2d(np.asarray(dens, dtype=float))
+    m = len(nums)
+    totals = cluster_totals(np.concatenate([nums, dens]), clusters)
+    samples = resample_totals(totals, n_resamples, seed, workers)
+    estimates = _ratio(totals[:m].sum(axis=1), totals[m:].sum(axis=1))
+    ratios = _ratio(samples[:, :m], samples[:, m:])
+    return [_interval(float(estimates[i]), ratios[:, i], confidence) for i in range(m)]
+
+
+def bootstrap_ratio(num: Any, den: Any = None, **kwargs: Any) -> Interval:
+    """Same as bootstrap_ratios() for a single ratio."""
+    return bootstrap_ratios(num, den, **kwargs)[0]
+
+
+def bootstrap_difference(
+    num_a: Any,
+    num_b: Any,
+    den_a: Any = None,
+    den_b: Any = None,
+    clusters: Optional[Sequence] = None,
+    n_resamples: int = 10_000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    workers: int = 1,
+) -> Interval:
+    """
+    Paired bootstrap confidence interval of the difference of ratios B - A, like the
+    accuracy difference of two models on the same rows. Both are computed on the same
+    resampled clusters, so the pairing is kept.
+    """
+    num_a, num_b = np.asarray(num_a, dtype=float), np.asarray(num_b, dtype=float)
+    den_a = np.ones_like(num_a) if den_a is None else np.asarray(den_a, dtype=float)
+    den_b = np.ones_like(num_b) if den_b is None else np.asarray(den_b, dtype=float)
+    totals = cluster_totals(np.stack([num_a, den_a, num_b, den_b]), clusters)
+    samples = resample_totals(totals, n_resamples, seed, workers)
+    t = totals.sum(axis=1)
+    estimate = float(_ratio(t[2], t[3]) - _ratio(t[0], t[1]))
+    differences = _ratio(samples[:, 2], samples[:, 3]) - _ratio(samples[:, 0], samples[:, 1])
+    return _interval(estimate, differences, confidence)
+
+
+def format_interval(interval: Interval, confidence: float = 0.95) -> str:
+    """Format a rate and its interval, like "80.00% (95% CI 72.41%–86.67%)"."""
+    estimate, low, high = interval
+    return f"{estimate:.2%} ({confidence:.0%} CI {low:.2%}–{high:.2%})"
@@ -1,57 +1,219 @@
 import json
-from typing import Any, Dict, Tuple
+import os
+import sqlite3
+import tempfile
+import time
+from logging import getLogger
+from threading import Lock, Thread
+from typing import IO, Any, Dict, List, Optional, Tuple
 
-from medask.util.log import get_logger
-
-logger = get_logger("medask.util.cache")
+logger = getLogger(__name__)
 
 
 class FileCache:
     """
-    Filecache dumping self._cache dict as JSON to <abs_path> with backup to .backup.
+    Filecache storing self._cache dict in <abs_path> as an append-only log of JSON lines,
+    one {"k": key, "v": value} record per cached item, next to an in-memory index.
+    Adding is O(1) I/O: records are appended and fsynced once per add. Once the log holds
+    more than <compact_ratio> times as many records as there are keys, it is compacted by
+    a background thread. A partially written last record (after a crash) is truncated.
+    :param compact_min: Don't compact logs with fewer records than this.
     """
 
-    def __init__(self, abs_path: str) -> None:
+    _HEADER = {"format": "medask.filecache", "version": 1}
+
+    def __init__(self, abs_path: str, compact_ratio: float = 2.0, compact_min: int = 1000) -> None:
         self._path = abs_path
-        self._path_to_backup = f"{abs_path}.backup"
-        self._cache: Dict[str, Any] = self._load() or {}
+        self._compact_ratio = compact_ratio
+        self._compact_min = compact_min
+        self._lock = Lock()
+        self._cache: Dict[str, Any] = {}
+        self._records = 0  # Number of records in the log, including overwritten ones.
+        self._pending: Optional[List[str]] = None  # Records added during compaction.
+        self._compactor: Optional[Thread] = None
         self._tainted = False
+        self._load()
+        self._file = open(self._path, "a", encoding="utf-8")
+
+    @classmethod
+    def _record(cls, key: str, value: Any) -> str:
+        return json.dumps({"k": key, "v": value}, ensure_ascii=False) + "\n"
 
-    def _load(self) -> Dict[str, Any]:
-        """Load cache from disk."""
+    def _load(self) -> None:
+        """Load the log from disk into self._cache, recovering from a torn last record."""
         try:
-            with open(self._path) as f:
-                return json.load(f)
-        except json.JSONDecodeError as e:
-            logger.warning(f"FileCache read error {e}")
-            return {}
+            with open(self._path, "rb") as f:
+                data = f.read()
         except FileNotFoundError:
-            return {}
+            self._rewrite({})
+            return
 
-    def _dump(self) -> None:
-        """
-        Dump cache to disk after each write.
-        If the write fails the cache gets tainted and no longer dumped to disk. This
-            preserves the backup pristine.
-        """
-        if self._tainted:
-            logger.warning(f"Tainted so skipping dumping {len(self._cache)}")
+        lines = data.split(b"\n")
+        try:
+            header = json.loads(lines[0])
+        except json.JSONDecodeError:
+            header = None
+        if header != self._HEADER:
+            self._load_legacy()
             return
+
+        next_offset = len(lines[0]) + 1
+        for i, line in enumerate(lines[1:], start=1):
+            # Byte offset of this record, advanced before parsing so no branch skips it.
+            offset, next_offset = next_offset, next_offset + len(line) + 1
+            last = i == len(lines) - 1
+            try:
+                if last and line:
+                    raise ValueError("Record not terminated by a newline.")
+                if line:
+                    record = json.loads(line)
+                    self._cache[record["k"]] = record["v"]
+                    self._records += 1
+            except (ValueError, KeyError, TypeError) as e:
+                if not last:
+                    logger.warning(f"FileCache skipping corrupt record {i} of {self._path}: {e}")
+                    continue
+                logger.warning(f"FileCache truncating torn record at byte {offset}: {e}")
+                with open(self._path, "r+b") as f:
+                    f.truncate(offset)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def _load_legacy(self) -> None:
+        """Convert a cache file from before the log format, a single JSON dict."""
+        for path in (self._path, f"{self._path}.backup"):
+            try:
+                with open(path) as f:
+                    cache = json.load(f)
+                if isinstance(cache, dict):
+                    logger.info(f"FileCache converting {path} to the log format.")
+                    self._rewrite(cache)
+                    return
+            except (json.JSONDecodeError, FileNotFoundError) as e:
+                logger.warning(f"FileCache read error {e}")
+
+        corrupt = f"{self._path}.corrupt"
+        logger.warning(f"FileCache moving unreadable {self._path} to {corrupt}")
+        os.replace(self._path, corrupt)
+        self._rewrite({})
+
+    def _write_log(self, f: IO[str], cache: Dict[str, Any]) -> None:
+        f.write(json.dumps(self._HEADER) + "\n")
+        f.writelines(self._record(k, v) for k, v in cache.items())
+
+    def _open_tmp(self) -> Tuple[IO[str], str]:
+        """Open a new temporary file next to the log, unique to the writer calling this."""
+        directory, name = os.path.split(os.path.abspath(self._path))
+        fd, tmp = tempfile.mkstemp(prefix=f"{name}.", suffix=".tmp", dir=directory)
+        return os.fdopen(fd, "w", encoding="utf-8"), tmp
+
+    def _rewrite(self, cache: Dict[str, Any]) -> None:
+        """Atomically replace the log with one record for each item of <cache>."""
+        f, tmp = self._open_tmp()
         try:
-            for path in (self._path, self._path_to_backup):
-                with open(path, "w") as f:
-                    json.dump(self._cache, f)
+            with f:
+                self._write_log(f, cache)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._cache = cache
+        self._records = len(cache)
+
+    def _maybe_compact(self) -> None:
+        """Start compacting in the background if the log is mostly garbage."""
+        if self._pending is not None or self._records < self._compact_min:
+            return
+        if self._records < self._compact_ratio * len(self._cache):
+            return
+        self._pending = []
+        self._compactor = Thread(target=self._compact, args=(dict(self._cache),), daemon=True)
+        self._compactor.start()
+
+    def _compact(self, snapshot: Dict[str, Any]) -> None:
+        """Write <snapshot> to a new log without blocking writers, then swap the logs."""
+        tmp = None
+        try:
+            f, tmp = self._open_tmp()
+            with f:
+                self._write_log(f, snapshot)
+                # Records added while the snapshot was written get appended under the lock.
+                with self._lock:
+                    pending = self._pending or []
+                    f.writelines(pending)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self._file.close()
+                    os.replace(tmp, self._path)
+                    self._file = open(self._path, "a", encoding="utf-8")
+                    self._records = len(snapshot) + len(pending)
+                    self._pending = None
         except Exception as e:
-            logger.exception(f"Error dumping to disk: {e}")
-            self._tainted = True
+            logger.exception(f"Error compacting {self._path}: {e}")
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+            with self._lock:
+                self._pending = None
+                if self._file.closed:
+                    self._file = open(self._path, "a", encoding="utf-8")
+
+    def compact(self) -> None:
+        """Compact the log now, waiting for it to finish."""
+        while True:
+            with self._lock:
+                # An add() may start a background compaction at any time; wait for it, as
+                # the two must not replace the log at once.
+                if self._pending is None:
+                    self._file.close()
+                    try:
+                        self._rewrite(dict(self._cache))
+                    finally:
+                        self._file = open(self._path, "a", encoding="utf-8")
+                    return
+                compactor = self._compactor
+            compactor.join()
+
+    def close(self) -> None:
+        if self._compactor is not None:
+            self._compactor.join()
+        with self._lock:
+            self._file.close()
 
     def add(self, items: Dict[str, Any], overwrite: bool = False) -> None:
-        """Add <items> to the cache."""
-        for k, v in items.items():
-            k = str(k)
-            if overwrite or k not in self._cache:
-                self._cache[k] = v
-        self._dump()
+        """
+        Add <items> to the cache, with a single write and fsync.
+        If the write fails the cache gets tainted and no longer written to disk. This
+            preserves the log pristine.
+        """
+        with self._lock:
+            new = {}
+            for k, v in items.items():
+                k = str(k)
+                if overwrite or k not in self._cache:
+                    new[k] = v
+            if not new:
+                return
+            self._cache.update(new)
+            if self._tainted:
+                logger.warning(f"Tainted so skipping writing {len(new)} items")
+                return
+
+            records = [self._record(k, v) for k, v in new.items()]
+            try:
+                self._file.write("".join(records))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except Exception as e:
+                logger.exception(f"Error writing to disk: {e}")
+                self._tainted = True
+                return
+            self._records += len(records)
+            if self._pending is not None:
+                self._pending.extend(records)
+            else:
+                self._maybe_compact()
 
     def has_key(self, key: str) -> Tuple[bool, Any]:
         """If the cache contains <key>, return True and the corresponding value."""
@@ -60,3 +222,94 @@ class FileCache:
             return True, self._cache[key]
         else:
             return False, None
+
+
+class SqliteCache:
+    """
+    Cache of JSON serializable values in a SQLite database in WAL mode, so it can be shared
+    by many threads and processes at once. Same interface as FileCache.
+    :param max_entries: If set, the least recently used entries are evicted beyond this size.
+    :param max_age: If set, entries older than <max_age> seconds are dropped.
+    """
+
+    _EVICT_EVERY = 1000  # Number of adds between evictions.
+
+    def __init__(
+        self, abs_path: str, max_entries: Optional[int] = None, max_age: Optional[float] = None
+    ) -> None:
+        self._path = abs_path
+        self._max_entries = max_entries
+        self._max_age = max_age
+        self._lock = Lock()
+        self._adds = 0
+        self._conn = sqlite3.connect(
+            abs_path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed)")
+        self.evict()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def evict(self) -> None:
+        """Drop expired entries, then the least recently used ones beyond max_entries."""
+        with self._lock:
+            if self._max_age is not None:
+                cutoff = time.time() - self._max_age
+                self._conn.execute("DELETE FROM cache WHERE created < ?", (cutoff,))
+            if self._max_entries is not None:
+                self._conn.execute(
+                    """DELETE FROM cache WHERE key IN (
+                        SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                    )""",
+                    (self._max_entries,),
+                )
+
+    def add(self, items: Dict[str, Any], overwrite: bool = False) -> None:
+        """Add <items> to the cache, in a single transaction."""
+        now = time.time()
+        rows = [(str(k), json.dumps(v), now, now) for k, v in items.items()]
+        verb = "INSERT OR REPLACE" if overwrite else "INSERT OR IGNORE"
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(f"{verb} INTO cache VALUES (?, ?, ?, ?)", rows)
+                self._conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                logger.exception(f"Error writing to {self._path}: {e}")
+                return
+            self._adds += len(rows)
+            evict = self._adds >= self._EVICT_EVERY
+            if evict:
+                self._adds = 0
+        if evict:
+            self.evict()
+
+    def has_key(self, key: str) -> Tuple[bool, Any]:
+        """If the cache contains <key>, return True and the corresponding value."""
+        key = str(key)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return False, None
+            value, created = row
+            if self._max_age is not None and created < time.time() - self._max_age:
+                return False, None
+            self._conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (time.time(), key))
+        return True, json.loads(value)
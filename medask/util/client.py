@@ -3,9 +3,12 @@ Utility functions for making http requests.
 """
 
 import json
+import httpx
 import requests
 from logging import getLogger
-from typing import TYPE_CHECKING, Any, Dict, Optional
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, Optional
+
+from medask.util.concurrency import per_loop
 
 if TYPE_CHECKING:
     from requests.models import Response
@@ -16,9 +19,10 @@ _logger = getLogger("medask.util.client")
 requests.packages.urllib3.disable_warnings()
 
 _session = requests.session()
+_asession = per_loop(lambda: httpx.AsyncClient(verify=False))
 
 
-def _decode(resp: "Response") -> Dict[str, Any]:
+def _decode(resp: "Response | httpx.Response") -> Dict[str, Any]:
     """Unmarshal the response object content."""
     content = resp.content.decode("utf-8")
     if resp.status_code != 200:
@@ -48,3 +52,35 @@ def post(path: str, body: str, url: str, timeout: Optional[float] = None) -> Dic
         verify=False,
     )
     return _decode(resp)
+
+
+async def apost(path: str, body: str, url: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+    """Make async POST request to the server."""
+    resp = await _asession().post(
+        f"{url}/{path}",
+        content=body.encode("utf-8"),
+        timeout=timeout,
+    )
+    return _decode(resp)
+
+
+async def astream_post(
+    path: str, body: str, url: str, timeout: Optional[float] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """Make async POST request to the server, yield the data of its server-sent events."""
+    async with _asession().stream(
+        "POST",
+        f"{url}/{path}",
+        content=body.encode("utf-8"),
+        timeout=timeout,
+    ) as resp:
+        if resp.status_code != 200:
+            content = (await resp.aread()).decode("utf-8")
+            raise RuntimeError(f"Request failed. {resp.status_code} - {content}")
+        async for line in resp.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:") :].strip()
+            if data == "[DONE]":
+                return
+            yield json.loads(data)
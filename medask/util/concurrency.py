@@ -1,5 +1,27 @@
-from typing import Any, Callable, Dict, List, Optional, Sequence
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from logging import getLogger
+from threading import Event, Lock
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    TypeVar,
+)
 from concurrent.futures import ThreadPoolExecutor
+from weakref import WeakKeyDictionary
+
+logger = getLogger(__name__)
+
+T = TypeVar("T")
 
 
 def exec_concurrently(
@@ -23,3 +45,203 @@ def exec_concurrently(
 
     results = [future.result() for future in futures]
     return results
+
+
+async def aexec_concurrently(
+    func: Callable | Sequence[Callable],
+    params: List[Dict[str, Any]],
+    max_workers: Optional[int] = None,
+) -> List[Any]:
+    """
+    Asyncio version of exec_concurrently, <func> being 1 or a sequence of coroutine functions.
+    All executions share the running event loop instead of using a thread each.
+    The results are guaranteed in the same order as <params>.
+    :param max_workers: If supplied, await at most <max_workers> executions at a time. Else,
+        all of them are awaited at once.
+    """
+    funcs = len(params) * [func] if callable(func) else func
+    assert len(funcs) == len(params), "func must be 1 callable or sequence of len len(params)"
+
+    semaphore = asyncio.Semaphore(max_workers or len(params) or 1)
+
+    async def _run(func: Callable, p: Dict[str, Any]) -> Any:
+        async with semaphore:
+            return await func(**p)
+
+    return await asyncio.gather(*(_run(func, p) for func, p in zip(funcs, params)))
+
+
+def per_loop(factory: Callable[[], T]) -> Callable[[], T]:
+    """
+    Return a getter lazily creating one instance of <factory>() per running event loop.
+    Async http clients bind their connection pool to the loop they were first used in, so
+    a single module level instance breaks as soon as asyncio.run is called a second time.
+    """
+    instances: "WeakKeyDictionary[asyncio.AbstractEventLoop, T]" = WeakKeyDictionary()
+    lock = Lock()
+
+    def _get() -> T:
+        loop = asyncio.get_running_loop()
+        with lock:
+            if loop not in instances:
+                instances[loop] = factory()
+            return instances[loop]
+
+    return _get
+
+
+def is_congestion(e: Exception) -> bool:
+    """True if <e> signals an overloaded backend: a timeout or a 429/5xx response."""
+    if isinstance(e, TimeoutError) or "Timeout" in type(e).__name__:
+        return True
+    status = getattr(e, "status_code", None) or getattr(e, "status", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+class AIMDLimiter:
+    """
+    Limit on the number of in-flight requests to one backend, adapted like TCP congestion
+    control: additive increase while the backend is healthy, multiplicative decrease on
+    congestion (429s, timeouts, 5xx or latency spikes).
+    Can be used from threads (acquire) and coroutines (aacquire) at the same time, waiters
+    get slots in FIFO order.
+    :param initial: Starting concurrency.
+    :param decrease: Factor by which the limit is cut on congestion.
+    :param latency_factor: A request is a latency spike if it takes <latency_factor> times
+        longer than the moving average.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        decrease: float = 0.5,
+        latency_factor: float = 3.0,
+    ) -> None:
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._waiters: Deque[Callable[[], None]] = deque()
+        self._lock = Lock()
+        self._latency: Optional[float] = None  # Moving average of healthy latencies.
+        self._samples = 0
+        self._last_decrease = 0.0
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, int(self._limit))
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def configure(self, initial: Optional[int] = None, max_limit: Optional[int] = None) -> None:
+        """Reset the current limit to <initial> and/or change the upper bound."""
+        with self._lock:
+            if max_limit is not None:
+                self.max_limit = max_limit
+            if initial is not None:
+                self._limit = float(initial)
+            self._limit = min(self._limit, float(self.max_limit))
+            self._hand_over()
+
+    def _try_take(self) -> bool:
+        if self._in_flight < self.limit:
+            self._in_flight += 1
+            return True
+        return False
+
+    def _hand_over(self) -> None:
+        """Give free slots to waiters. Must hold self._lock."""
+        while self._waiters and self._in_flight < self.limit:
+            self._in_flight += 1
+            self._waiters.popleft()()
+
+    def acquire(self) -> None:
+        """Block until a slot is free."""
+        event = Event()
+        with self._lock:
+            if self._try_take():
+                return
+            self._waiters.append(event.set)
+        event.wait()
+
+    async def aacquire(self) -> None:
+        """Async version of self.acquire()."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def _wake() -> None:
+            # A cancelled waiter doesn't use the slot it got handed.
+            if future.cancelled():
+                self.release()
+            else:
+                future.set_result(None)
+
+        with self._lock:
+            if self._try_take():
+                return
+            self._waiters.append(lambda: loop.call_soon_threadsafe(_wake))
+        await future
+
+    def release(self, latency: Optional[float] = None, congested: bool = False) -> None:
+        """
+        Free a slot and adapt the limit to how the request went.
+        :param latency: Duration of a successful request, None if it failed.
+        :param congested: True if the request failed because the backend is overloaded.
+        """
+        with self._lock:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if latency is not None and not congested and self._latency is not None:
+                spike = self._samples >= 5 and latency > self.latency_factor * self._latency
+                congested = spike
+            if congested:
+                # React once per round trip, not to every request of a burst failing together.
+                if now - self._last_decrease > (self._latency or 1.0):
+                    self._limit = max(self.min_limit, self._limit * self.decrease)
+                    self._last_decrease = now
+                    logger.info(f"{self.name} congested, concurrency down to {self.limit}.")
+            elif latency is not None:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            if latency is not None:
+                self._samples += 1
+                avg = self._latency
+                self._latency = latency if avg is None else 0.9 * avg + 0.1 * latency
+            self._hand_over()
+
+    @contextmanager
+    def slot(self, congestion: Callable[[Exception], bool] = is_congestion) -> Iterator[None]:
+        """Hold a slot for the duration of a request, adapting the limit to its outcome."""
+        self.acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.release(congested=isinstance(e, Exception) and congestion(e))
+            raise
+        self.release(latency=time.perf_counter() - start)
+
+    @asynccontextmanager
+    async def aslot(
+        self, congestion: Callable[[Exception], bool] = is_congestion
+    ) -> AsyncIterator[None]:
+        """Async version of self.slot()."""
+        await self.aacquire()
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.release(congested=isinstance(e, Exception) and congestion(e))
+            raise
+        self.release(latency=time.perf_counter() - start)
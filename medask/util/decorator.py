@@ -1,3 +1,4 @@
+import inspect
 import time
 from copy import deepcopy
 from functools import lru_cache, wraps
@@ -12,12 +13,7 @@ def timeit(
     logger: Optional[Logger] = None, log_args: bool = False, log_kwargs: bool = False
 ) -> Callable:
     def _timeit(func: Callable) -> Callable:
-        @wraps(func)
-        def _decorator(*args: Any, **kwargs: Any) -> Any:
-            start_time = time.perf_counter()
-            result = func(*args, **kwargs)
-            total_time = time.perf_counter() - start_time
-
+        def _log(total_time: float, args: Any, kwargs: Any) -> None:
             # Log the function and potentially args and kwargs.
             text = f"Function <{func.__name__}"
             if log_args:
@@ -28,6 +24,22 @@ def timeit(
             log = logger or _logger
             log.info(text)
 
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def _adecorator(*args: Any, **kwargs: Any) -> Any:
+                start_time = time.perf_counter()
+                result = await func(*args, **kwargs)
+                _log(time.perf_counter() - start_time, args, kwargs)
+                return result
+
+            return _adecorator
+
+        @wraps(func)
+        def _decorator(*args: Any, **kwargs: Any) -> Any:
+            start_time = time.perf_counter()
+            result = func(*args, **kwargs)
+            _log(time.perf_counter() - start_time, args, kwargs)
             return result
 
         return _decorator
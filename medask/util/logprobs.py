@@ -0,0 +1,34 @@
+import math
+from typing import Any, Dict, List
+
+# Most candidates of a token whose logprobs OpenAI-compatible APIs return.
+TOP_LOGPROBS = 20
+
+
+def label_distribution(top_logprobs: List[Any], labels: List[str]) -> Dict[str, float]:
+    """
+    Probability of each of <labels> among the candidates <top_logprobs> of one generated
+    token, objects with a token and its logprob. Candidates are matched to a label case
+    insensitively, ignoring whitespace and backticks, so " EM" counts for "em". The result
+    is renormalized over <labels>, and empty if none of them is among the candidates.
+    """
+    mass = {label: 0.0 for label in labels}
+    for candidate in top_logprobs:
+        token = candidate.token.strip().strip("`").lower()
+        if token in mass:
+            mass[token] += math.exp(candidate.logprob)
+    total = sum(mass.values())
+    if total == 0:
+        return {}
+    return {label: p / total for label, p in mass.items()}
+
+
+def first_token_logprobs(completion: Any) -> List[Any]:
+    """
+    Top logprobs of the first token of a chat <completion>, empty if the server left them
+    out, as servers ignoring the logprobs parameter do.
+    """
+    logprobs = completion.choices[0].logprobs if completion.choices else None
+    if logprobs is None or not logprobs.content:
+        return []
+    return logprobs.content[0].top_logprobs or []
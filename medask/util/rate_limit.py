@@ -0,0 +1,414 @@
+"""
+Process wide rate limiting of LLM API calls.
+One RateLimiter per (provider, model) is shared by all threads and coroutines, so calls are
+metered before they go out, instead of every caller backing off on its own after a 429.
+Each RateLimiter also adapts how many calls to its backend are in flight at once.
+"""
+
+import asyncio
+import re
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from logging import getLogger
+from threading import Lock
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from medask.util.concurrency import AIMDLimiter, is_congestion
+
+logger = getLogger(__name__)
+
+T = TypeVar("T")
+
+# Default (requests per minute, tokens per minute) budget of each provider. None means
+# unlimited. Limits depend on the account tier, they get corrected from the rate limit
+# headers of the first response, or can be set explicitly with configure_rate_limit.
+DEFAULT_LIMITS: Dict[str, Tuple[Optional[float], Optional[float]]] = {
+    "openai": (5_000, 450_000),
+    "anthropic": (50, 40_000),
+    "mistral": (60, 500_000),
+    "deepseek": (None, None),  # DeepSeek doesn't impose rate limits.
+    "replicate": (600, None),
+}
+
+# Starting number of in-flight requests of each provider, adapted by AIMDLimiter.
+DEFAULT_CONCURRENCY: Dict[str, int] = {
+    "openai": 8,
+    "anthropic": 2,
+    "koboldcpp": 1,
+    "local": 1,
+}
+
+# Assumed length of the completion, when estimating the tokens of a request up front.
+EXPECTED_OUTPUT_TOKENS = 300
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def estimate_tokens(history: Any, max_output: int = EXPECTED_OUTPUT_TOKENS) -> int:
+    """Rough token count of a request with messages <history>, ~4 characters a token."""
+    chars = sum(len(str(msg.get("content", ""))) for msg in history)
+    return chars // 4 + max_output
+
+
+def _parse_seconds(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a rate limit header value into seconds from now. Supported are plain seconds
+    ("20"), durations ("120ms", "1.5s", "6m0s"), HTTP dates and RFC 3339 timestamps.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    if parts := _DURATION_PART.findall(value):
+        scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(n) * scale[unit] for n, unit in parts)
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            dt = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return max(0.0, (dt - datetime.now(timezone.utc)).total_seconds())
+
+
+def _headers_of(e: Exception) -> Optional[Mapping[str, str]]:
+    """Return the http response headers attached to the SDK exception <e>, if any."""
+    response = getattr(e, "response", None) or getattr(e, "raw_response", None)
+    return getattr(response, "headers", None)
+
+
+def _congestion(is_rate_limit: Callable[[Exception], bool]) -> Callable[[Exception], bool]:
+    return lambda e: is_rate_limit(e) or is_congestion(e)
+
+
+def retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """Seconds to wait according to the Retry-After headers, None if not present."""
+    if not headers:
+        return None
+    headers = {k.lower(): v for k, v in headers.items()}
+    if ms := _parse_seconds(headers.get("retry-after-ms")):
+        return ms / 1000
+    return _parse_seconds(headers.get("retry-after"))
+
+
+class _Bucket:
+    """
+    Token bucket holding up to <per_minute> units, refilled continuously.
+    Takes are allowed to overdraw the bucket, the debt being the time the caller has to wait.
+    That way concurrent callers queue up at the refill rate instead of waking up together.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        rate = self.capacity / 60
+        self.level = min(self.capacity, self.level + (now - self._updated) * rate)
+        self._updated = now
+
+    def take(self, amount: float, now: float) -> float:
+        """Take <amount> units, return seconds until the bucket is out of debt."""
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level * 60 / self.capacity)
+
+    def cap(self, remaining: float, now: float) -> None:
+        """Lower the level to what the provider reports as <remaining>."""
+        self._refill(now)
+        self.level = min(self.level, remaining)
+
+    def give(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """
+    Requests per minute and tokens per minute budget for one (provider, model).
+    :param rpm: Requests per minute, None for unlimited.
+    :param tpm: Tokens per minute, None for unlimited.
+    :param concurrency: Starting number of calls in flight, adapted to the backend's health.
+    :param max_retries: Number of rate limited attempts after which a call gives up.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        concurrency: int = 4,
+        max_retries: int = 10,
+    ) -> None:
+        self.name = name
+        self.max_retries = max_retries
+        self.concurrency = AIMDLimiter(name, initial=concurrency)
+        self._lock = Lock()
+        self._requests = _Bucket(rpm) if rpm else None
+        self._tokens = _Bucket(tpm) if tpm else None
+        self._paused_until = 0.0
+        self._strikes = 0  # Consecutive rate limit errors.
+
+    def configure(self, rpm: Optional[float] = None, tpm: Optional[float] = None) -> None:
+        """Change the per minute budgets, keeping the current bucket levels."""
+        with self._lock:
+            for attr, per_minute in (("_requests", rpm), ("_tokens", tpm)):
+                bucket = getattr(self, attr)
+                if not per_minute:
+                    setattr(self, attr, None)
+                elif bucket is None:
+                    setattr(self, attr, _Bucket(per_minute))
+                else:
+                    bucket.capacity = float(per_minute)
+                    bucket.level = min(bucket.level, bucket.capacity)
+
+    def _pause_left(self) -> float:
+        return self._paused_until - time.monotonic()
+
+    def _reserve(self, tokens: int) -> Tuple[float, bool]:
+        """
+        Take 1 request and <tokens> tokens from the budget.
+        :return: Seconds to wait before sending, and whether the budget was taken. Nothing
+            is taken during a pause, the caller should retry once the pause is over.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if (pause := self._paused_until - now) > 0:
+                return pause, False
+            wait = 0.0
+            if self._requests is not None:
+                wait = max(wait, self._requests.take(1, now))
+            if self._tokens is not None:
+                wait = max(wait, self._tokens.take(tokens, now))
+            return wait, True
+
+    def acquire(self, tokens: int = 0) -> None:
+        """Block until a request of <tokens> tokens fits in the budget."""
+        while True:
+            wait, reserved = self._reserve(tokens)
+            if wait > 0:
+                time.sleep(wait)
+            # If a pause started while waiting, reserve again once it's over.
+            if reserved and self._pause_left() <= 0:
+                return
+
+    async def aacquire(self, tokens: int = 0) -> None:
+        """Async version of self.acquire()."""
+        while True:
+            wait, reserved = self._reserve(tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if reserved and self._pause_left() <= 0:
+                return
+
+    def settle(self, reserved: int, used: Optional[int]) -> None:
+        """Correct the token budget once the real usage of a request is known."""
+        if used is None or self._tokens is None:
+            return
+        with self._lock:
+            self._tokens.give(reserved - used, time.monotonic())
+
+    def pause(self, seconds: Optional[float] = None) -> None:
+        """
+        Pause all callers after being rate limited. If the provider did not say for how
+        long, back off exponentially with the number of consecutive rate limit errors.
+        """
+        with self._lock:
+            self._strikes += 1
+            if seconds is None:
+                seconds = min(60.0, 3.0 * 1.5 ** (self._strikes - 1))
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            # Once the pause is over, let requests go out at the refill rate only.
+            if self._requests is not None:
+                self._requests.cap(0, now)
+        logger.info(f"{self.name} rate limited, pausing for {round(seconds, 1)} seconds.")
+
+    def update_from_headers(self, headers: Optional[Mapping[str, str]]) -> None:
+        """
+        Sync the budget with the rate limit headers of an OpenAI or Anthropic response:
+        the limits, what remains of them and when they reset.
+        """
+        if not headers:
+            return
+        headers = {k.lower(): v for k, v in headers.items()}
+        reported: Dict[str, Tuple[float, float, Optional[float]]] = {}
+        for kind in ("requests", "tokens"):
+            for prefix in ("x-ratelimit-{}-" + kind, "anthropic-ratelimit-" + kind + "-{}"):
+                try:
+                    limit = float(headers[prefix.format("limit")])
+                    remaining = float(headers[prefix.format("remaining")])
+                except (KeyError, ValueError):
+                    continue
+                reset = _parse_seconds(headers.get(prefix.format("reset")))
+                reported[kind] = (limit, remaining, reset)
+        if not reported:
+            return
+
+        with self._lock:
+            capacities = {
+                "requests": self._requests.capacity if self._requests else None,
+                "tokens": self._tokens.capacity if self._tokens else None,
+            }
+        if any(capacities[kind] != limit for kind, (limit, _, _) in reported.items()):
+            capacities.update({kind: limit for kind, (limit, _, _) in reported.items()})
+            self.configure(rpm=capacities["requests"], tpm=capacities["tokens"])
+
+        with self._lock:
+            now = time.monotonic()
+            for kind, (_, remaining, reset) in reported.items():
+                bucket = self._requests if kind == "requests" else self._tokens
+                if bucket is not None:
+                    bucket.cap(remaining, now)
+                if remaining <= 0 and reset:
+                    self._paused_until = max(self._paused_until, now + reset)
+
+    def _on_success(self, result: Any) -> None:
+        with self._lock:
+            self._strikes = 0
+        self.update_from_headers(getattr(result, "headers", None))
+
+    def _on_rate_limit(self, e: Exception) -> None:
+        headers = _headers_of(e)
+        self.update_from_headers(headers)
+        self.pause(retry_after(headers))
+
+    def call(
+        self, func: Callable[[], T], tokens: int, is_rate_limit: Callable[[Exception], bool]
+    ) -> T:
+        """
+        Call <func> once it fits into the budget and a concurrency slot is free, retrying
+        when it raises an exception for which <is_rate_limit> is True. If the result of
+        <func> has http headers (like a raw SDK response), the budget is synced with them.
+        """
+        congestion = _congestion(is_rate_limit)
+        for _ in range(self.max_retries):
+            self.acquire(tokens)
+            try:
+                with self.concurrency.slot(congestion):
+                    result = func()
+            except Exception as e:
+                if not is_rate_limit(e):
+                    raise
+                self._on_rate_limit(e)
+                continue
+            self._on_success(result)
+            return result
+
+        raise RuntimeError("Too much rate limiting")
+
+    async def acall(
+        self,
+        func: Callable[[], Any],
+        tokens: int,
+        is_rate_limit: Callable[[Exception], bool],
+    ) -> Any:
+        """Async version of self.call(), <func> returning an awaitable."""
+        congestion = _congestion(is_rate_limit)
+        for _ in range(self.max_retries):
+            await self.aacquire(tokens)
+            try:
+                async with self.concurrency.aslot(congestion):
+                    result = await func()
+            except Exception as e:
+                if not is_rate_limit(e):
+                    raise
+                self._on_rate_limit(e)
+                continue
+            self._on_success(result)
+            return result
+
+        raise RuntimeError("Too much rate limiting")
+
+    @asynccontextmanager
+    async def astream(
+        self,
+        open_stream: Callable[[], Any],
+        tokens: int,
+        is_rate_limit: Callable[[Exception], bool],
+    ) -> AsyncIterator[Any]:
+        """
+        Open a streamed response with the awaitable <open_stream>, retrying like
+        self.acall(), and hold a concurrency slot until the stream has been consumed.
+        Only opening the stream is retried, once chunks are read errors propagate.
+        """
+        congestion = _congestion(is_rate_limit)
+        for _ in range(self.max_retries):
+            await self.aacquire(tokens)
+            opened = False
+            try:
+                async with self.concurrency.aslot(congestion):
+                    stream = await open_stream()
+                    opened = True
+                    self._on_success(stream)
+                    yield stream
+                    return
+            except Exception as e:
+                if opened or not is_rate_limit(e):
+                    raise
+                self._on_rate_limit(e)
+
+        raise RuntimeError("Too much rate limiting")
+
+
+_limiters: Dict[Tuple[str, str], RateLimiter] = {}
+_overrides: Dict[Tuple[str, Optional[str]], Tuple[Optional[float], Optional[float]]] = {}
+_registry_lock = Lock()
+
+
+def configure_rate_limit(
+    provider: str,
+    rpm: Optional[float] = None,
+    tpm: Optional[float] = None,
+    model: Optional[str] = None,
+) -> None:
+    """Set the budget of <provider>, or only of its <model> if given."""
+    with _registry_lock:
+        _overrides[(provider, model)] = (rpm, tpm)
+        limiters = [
+            lim for (p, m), lim in _limiters.items() if p == provider and model in (None, m)
+        ]
+    for limiter in limiters:
+        limiter.configure(rpm=rpm, tpm=tpm)
+
+
+def rate_limiters() -> List[RateLimiter]:
+    """All RateLimiters created so far, one per backend."""
+    with _registry_lock:
+        return list(_limiters.values())
+
+
+def get_rate_limiter(provider: str, model: str) -> RateLimiter:
+    """Return the RateLimiter shared by everybody calling <model> of <provider>."""
+    with _registry_lock:
+        if (provider, model) not in _limiters:
+            rpm, tpm = _overrides.get(
+                (provider, model),
+                _overrides.get((provider, None), DEFAULT_LIMITS.get(provider, (None, None))),
+            )
+            _limiters[(provider, model)] = RateLimiter(
+                f"{provider}/{model}",
+                rpm=rpm,
+                tpm=tpm,
+                concurrency=DEFAULT_CONCURRENCY.get(provider, 4),
+            )
+        return _limiters[(provider, model)]
@@ -1,20 +1,58 @@
+import asyncio
+import glob
+import hashlib
+import inspect
+import json
+import os
+import re
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from logging import getLogger
-from typing import TYPE_CHECKING, Any, Dict
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
 from medask.models.comms.models import CMessage
 from medask.models.orm.models import Role
-from medask.ummon.openai import UmmonOpenAI
+from medask.ummon.base import BaseUmmon
+from medask.util.bootstrap import bootstrap_ratios, format_interval
+from medask.util.cache import SqliteCache
+from medask.util.concurrency import aexec_concurrently, per_loop
+from medask.util.rate_limit import estimate_tokens
 
+from medask.benchmark.experiment_result import MANIFEST, ExperimentResult
+from medask.benchmark.lazy_result import LazyExperimentResult
+from medask.benchmark.matcher import DiagnosisMatcher
 from medask.benchmark.simulator import NaiveSimulator
+from medask.benchmark.util import model_to_client
 
 if TYPE_CHECKING:
-    from medask.benchmark.experiment_result import ExperimentResult
+    from medask.models.comms.models import CChat
+
+    from medask.benchmark.vignette import Vignette
 
 logger = getLogger("benchmark.evaluate")
-_ummon_openai = UmmonOpenAI("gpt-4o")
+DEFAULT_EVALUATOR = "gpt-4o"
+
+# USD per million (input, output) tokens, matched on the start of the model name, most
+# specific first. Local servers cost nothing, unknown models are reported without cost.
+PRICES: List[Tuple[str, Tuple[float, float]]] = [
+    ("gpt-4o-mini", (0.15, 0.6)),
+    ("gpt-4o", (2.5, 10.0)),
+    ("claude-3-haiku", (0.25, 1.25)),
+    ("claude-3-5-haiku", (0.8, 4.0)),
+    ("claude-3-5-sonnet", (3.0, 15.0)),
+    ("claude-3-opus", (15.0, 75.0)),
+    ("open-mixtral-8x7b", (0.7, 0.7)),
+    ("mistral-large", (2.0, 6.0)),
+    ("mistral-small", (0.2, 0.6)),
+    ("deepseek", (0.27, 1.1)),
+    ("http://", (0.0, 0.0)),
+]
 
 
-def _get_score(obtained_diagnoses: str, correct_diagnosis: str) -> int:
+def _judge_prompt(obtained_diagnoses: str, correct_diagnosis: str) -> CMessage:
     body = f"""Given a list of differential diagnoses and the correct diagnosis. Determine if any diagnosis in the list is either
         an exact match or extremely relevant to the correct diagnosis.     A diagnosis is considered extremely relevant if it is:
         1. A direct subtype/variant of the condition (e.g., "Alzheimer's Disease" matches "Dementia")
@@ -30,8 +68,10 @@ def _get_score(obtained_diagnoses: str, correct_diagnosis: str) -> int:
         OBTAINED DIAGNOSES: {obtained_diagnoses}
         CORRECT DIAGNOSIS: {correct_diagnosis}
     """
-    cmsg = CMessage(user_id=1, body=body, role=Role.SYSTEM)
-    out = _ummon_openai.inquire(cmsg).body
+    return CMessage(user_id=1, body=body, role=Role.SYSTEM)
+
+
+def _parse_score(out: str, obtained_diagnoses: str, correct_diagnosis: str) -> int:
     try:
         # Extract just the number from "Correct diagnosis position: [number]"
         position_part = out.split("Position:")[1].strip()
@@ -43,44 +83,511 @@ def _get_score(obtained_diagnoses: str, correct_diagnosis: str) -> int:
         return -3
 
 
+def _get_score(
+    obtained_diagnoses: str, correct_diagnosis: str, ummon: Optional[BaseUmmon] = None
+) -> int:
+    ummon = ummon or model_to_client(DEFAULT_EVALUATOR)
+    cmsg = _judge_prompt(obtained_diagnoses, correct_diagnosis)
+    out = ummon.inquire(cmsg).body
+    return _parse_score(out, obtained_diagnoses, correct_diagnosis)
+
+
+def _batch_prompt(cases: Dict[str, Tuple[str, str]]) -> CMessage:
+    """Judge prompt for many <cases>, (obtained diagnoses, correct diagnosis) by case id."""
+    body = """Below are cases, each with a list of differential diagnoses and the correct diagnosis.
+        For each case, determine if any diagnosis in its list is either an exact match or
+        extremely relevant to its correct diagnosis. A diagnosis is considered extremely relevant if it is:
+        1. A direct subtype/variant of the condition (e.g., "Alzheimer's Disease" matches "Dementia")
+        2. A broader category that includes the condition (e.g., "Head Injury" matches "Concussion")
+        3. A temporal variation (e.g., "Acute Bronchitis" matches "Chronic Bronchitis")
+        4. A closely related condition with shared pathophysiology and clinical presentation (e.g., "Gout" matches "Pseudogout")
+        5. A condition with established pathophysiological link (e.g., "Chronic Sinusitis" matches "Nasal Polyps")
+
+        If any diagnosis meets these criteria, the position of the case is that of the diagnosis, starting from 1.
+        If none of the diagnoses meet these criteria, the position of the case is -1.
+        Respond with a JSON object mapping each case id to its position, like {"1": 2, "2": -1}.
+    """
+    for case_id, (obtained_diagnoses, correct_diagnosis) in cases.items():
+        body += f"""
+        CASE {case_id}
+        OBTAINED DIAGNOSES: {obtained_diagnoses}
+        CORRECT DIAGNOSIS: {correct_diagnosis}
+    """
+    return CMessage(user_id=1, body=body, role=Role.SYSTEM)
+
+
+def _parse_batch(out: str, case_ids: List[str]) -> Dict[str, int]:
+    """Valid positions in the batched judge reply <out>, by case id. Invalid ones are left out."""
+    match = re.search(r"\{.*\}", out, re.DOTALL)
+    try:
+        raw = json.loads(match.group()) if match else {}
+    except json.JSONDecodeError:
+        raw = {}
+    positions = {}
+    for case_id in case_ids:
+        position = raw.get(case_id) if isinstance(raw, dict) else None
+        if isinstance(position, str) and position.strip().lstrip("-").isdigit():
+            position = int(position)
+        if isinstance(position, int) and not isinstance(position, bool):
+            if position == -1 or position >= 1:
+                positions[case_id] = position
+    return positions
+
+
+class JudgeBatcher:
+    """
+    Pack the cases to judge into batched requests of up to <batch_size> cases each, sharing
+    the instructions, with the verdicts as a JSON object. Cases are queued as they come and
+    a batch is sent once it is full, or <linger> seconds after its first case arrived. Cases
+    missing or invalid in a reply are asked again in a new batch, up to <max_attempts> times,
+    after which they score -3 like an unparsable single-case reply.
+    Must be used from within a single event loop.
+    :param inquire: Send a prompt to the evaluator, in JSON mode if the flag is True.
+    """
+
+    def __init__(
+        self,
+        inquire: Callable[[CMessage, bool], Awaitable[str]],
+        batch_size: int = 10,
+        linger: float = 0.2,
+        max_attempts: int = 3,
+    ) -> None:
+        self.inquire = inquire
+        self.batch_size = batch_size
+        self.linger = linger
+        self.max_attempts = max_attempts
+        self._queue: List[Tuple[str, str, "asyncio.Future[int]"]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()  # Strong references to the running batches.
+
+    async def score(self, obtained_diagnoses: str, correct_diagnosis: str) -> int:
+        """Position of <correct_diagnosis> in <obtained_diagnoses>, as in _get_score()."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((obtained_diagnoses, correct_diagnosis, future))
+        if len(self._queue) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.linger, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._queue = self._queue[: self.batch_size], self._queue[self.batch_size :]
+        if batch:
+            task = asyncio.create_task(self._judge(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if self._queue:
+            self._timer = asyncio.get_running_loop().call_later(self.linger, self._flush)
+
+    async def _judge(self, batch: List[Tuple[str, str, "asyncio.Future[int]"]]) -> None:
+        pending = {str(i): case for i, case in enumerate(batch, start=1)}
+        for attempt in range(self.max_attempts):
+            cases = {i: (obtained, correct) for i, (obtained, correct, _) in pending.items()}
+            try:
+                out = await self.inquire(_batch_prompt(cases), True)
+            except Exception:
+                logger.exception(f"Batched judge request of {len(cases)} cases failed")
+                out = ""
+            for case_id, position in _parse_batch(out, list(cases)).items():
+                pending.pop(case_id)[2].set_result(position)
+            if not pending:
+                return
+            logger.warning(f"Asking again for {len(pending)} cases, {attempt=}: {out=}")
+
+        for obtained_diagnoses, correct_diagnosis, future in pending.values():
+            logger.error(f"FAILED: {obtained_diagnoses=} {correct_diagnosis=}")
+            future.set_result(-3)
+
+
 def get_score(obtained_diagnoses: str, correct_diagnosis: str) -> float:
     position = _get_score(obtained_diagnoses, correct_diagnosis)
     print(f"position={position}\t{correct_diagnosis}\t{obtained_diagnoses}")
     return float(position)
 
-def evaluate(result: "ExperimentResult") -> Dict[int, Dict[str, Any]]:
+
+def canonical_diagnoses(obtained_diagnoses: str) -> str:
+    """
+    Normalize the diagnoses list <obtained_diagnoses>, like "[Gout,  pseudogout ]", into
+    "gout, pseudogout": case-folded, without brackets and with normalized whitespace.
+    The order is preserved, since the judge returns a position in the list.
+    """
+    inner = obtained_diagnoses.strip().strip("[]")
+    diagnoses = [" ".join(d.split()).casefold() for d in inner.split(",")]
+    return ", ".join(d for d in diagnoses if d)
+
+
+class Judge:
+    """
+    Scores a diagnoses list against the correct diagnosis, with the evaluator <ummon>,
+    any client returned by model_to_client, including local servers.
+    :param concurrency: If given, the judge never has more than this many requests in
+        flight. Doctor and patient calls to the same model are not limited by it, but all
+        of them share the rate limits of the model.
+    :param batch_size: If above 1, up to <batch_size> cases are judged per request.
+    :param cache: If given, verdicts are stored in and looked up from it, keyed on the
+        evaluator model, the prompt and its version, the correct diagnosis and the
+        canonical diagnoses list. So cases already judged, in earlier experiments, reruns or
+        evaluations, are not judged again. Failed verdicts are not cached.
+    :param matcher: If given, cases it matches confidently are scored locally, and only the
+        others are sent to the evaluator.
+    """
+
+    # Bump when the judge prompts change, so cached verdicts of older prompts are not used.
+    PROMPT_VERSION = 1
+
+    def __init__(
+        self,
+        ummon: Optional[BaseUmmon] = None,
+        concurrency: Optional[int] = None,
+        batch_size: int = 1,
+        cache: Optional[SqliteCache] = None,
+        matcher: Optional[DiagnosisMatcher] = None,
+    ) -> None:
+        self.ummon = ummon or model_to_client(DEFAULT_EVALUATOR)
+        self._slots = per_loop(partial(asyncio.Semaphore, concurrency)) if concurrency else None
+        self.batcher = JudgeBatcher(self.ainquire, batch_size) if batch_size > 1 else None
+        self.cache = cache
+        self.matcher = matcher
+        # Number of cases scored by the matcher, from the cache and by the evaluator.
+        self.counts = {"local": 0, "cached": 0, "judged": 0}
+        # Latency, estimated input and output tokens of each request to the evaluator.
+        self._requests: List[Tuple[float, int, int]] = []
+        # Not every client takes the json flag.
+        self._takes_json = "json" in inspect.signature(self.ummon.ainquire).parameters
+
+    @property
+    def config(self) -> Dict[str, Any]:
+        """Everything about this judge that can change its verdicts."""
+        return {
+            "evaluator": self.ummon._model,
+            "prompt_version": self.PROMPT_VERSION,
+            "batch_size": self.batcher.batch_size if self.batcher else 1,
+            "local_match": self.matcher is not None,
+        }
+
+    async def ainquire(self, prompt: CMessage, json: bool = False) -> str:
+        """Send <prompt> to the evaluator and record the cost of the request."""
+        kwargs = {"json": True} if json and self._takes_json else {}
+        async with self._slots() if self._slots is not None else nullcontext():
+            start = time.perf_counter()
+            out = (await self.ummon.ainquire(prompt, **kwargs)).body
+        tokens_in = estimate_tokens([prompt.to_openai()], max_output=0)
+        self._requests.append((time.perf_counter() - start, tokens_in, len(out) // 4))
+        return out
+
+    def report(self) -> Dict[str, Any]:
+        """Latency and cost of the evaluation so far, also logged."""
+        model = self.ummon._model
+        latencies = sorted(latency for latency, _, _ in self._requests)
+        tokens_in = sum(t for _, t, _ in self._requests)
+        tokens_out = sum(t for _, _, t in self._requests)
+        price = next((p for prefix, p in PRICES if model.startswith(prefix)), None)
+        report = {
+            "evaluator": model,
+            **self.counts,
+            "requests": len(latencies),
+            "latency_p50": latencies[len(latencies) // 2] if latencies else None,
+            "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else None,
+            "tokens_in": tokens_in,
+            "tokens_out": tokens_out,
+            "cost_usd": price and (tokens_in * price[0] + tokens_out * price[1]) / 1e6,
+        }
+        logger.info(
+            f"Evaluator {model}: {report['local']} scored locally, {report['cached']} cached, "
+            f"{report['judged']} judged in {report['requests']} requests, latency p50 "
+            f"{report['latency_p50'] or 0:.2f}s p95 {report['latency_p95'] or 0:.2f}s, "
+            f"~{tokens_in} input and ~{tokens_out} output tokens, "
+            + (f"~${report['cost_usd']:.4f}" if price else "cost unknown")
+        )
+        return report
+
+    def _key(self, obtained_diagnoses: str, correct_diagnosis: str) -> str:
+        payload = {
+            "model": self.ummon._model,
+            "prompt_version": self.PROMPT_VERSION,
+            # Batched and single cases are judged with different prompts.
+            "prompt": "batch" if self.batcher else "single",
+            "correct": " ".join(correct_diagnosis.split()).casefold(),
+            "obtained": canonical_diagnoses(obtained_diagnoses),
+        }
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return "judge:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def ascore(self, obtained_diagnoses: str, correct_diagnosis: str) -> int:
+        """Position of <correct_diagnosis> in <obtained_diagnoses>, as in _get_score()."""
+        if self.matcher is not None:
+            position = self.matcher.match(obtained_diagnoses, correct_diagnosis)
+            if position is not None:
+                self.counts["local"] += 1
+                return position
+
+        if self.cache is not None:
+            key = self._key(obtained_diagnoses, correct_diagnosis)
+            hit, position = self.cache.has_key(key)
+            if hit:
+                self.counts["cached"] += 1
+                return position
+
+        self.counts["judged"] += 1
+        if self.batcher is not None:
+            position = await self.batcher.score(obtained_diagnoses, correct_diagnosis)
+        else:
+            out = await self.ainquire(_judge_prompt(obtained_diagnoses, correct_diagnosis))
+            position = _parse_score(out, obtained_diagnoses, correct_diagnosis)
+
+        if self.cache is not None and position != -3:
+            self.cache.add({key: position})
+        return position
+
+
+async def aget_score(
+    obtained_diagnoses: str, correct_diagnosis: str, judge: Optional[Judge] = None
+) -> float:
+    """Async version of get_score(), with <judge> or else a default Judge."""
+    position = await (judge or Judge()).ascore(obtained_diagnoses, correct_diagnosis)
+    print(f"position={position}\t{correct_diagnosis}\t{obtained_diagnoses}")
+    return float(position)
+
+
+def _extract_diagnoses(chat: "CChat", vignette: "Vignette") -> Optional[str]:
     """
-    Evaluation.
     Super hacky for now, we need to reconstruct the right Simulator, to know if the
     chat successfully finish and to extract the diagnosis.
-    :return: For each experiment from <num_experiments>, a dict of experiment results.
     """
-    result = result.copy()  # Make sure we don't accidentally modify the results.
-    results: Dict[int, Dict[str, Any]] = {i: {} for i in range(result.num_experiments)}
-    
-    for i in range(result.num_experiments):
-        positions = []
-        chats = result.chats[i]
-        for chat, vignette in zip(chats, result.vignettes):
-            simulator = NaiveSimulator(vignette, None, None)
-            simulator.chat_doctor = chat
-            if not simulator.diagnosis_finished:
-                logger.warning("Simulation did not finish with a diagnosis.")
-                positions.append(-2)
-                continue
-
-            obtained_diagnoses = simulator.extract_diagnoses()
-            correct_diagnosis = vignette.correct_diagnosis
-            positions.append(get_score(obtained_diagnoses, correct_diagnosis))
+    simulator = NaiveSimulator(vignette, None, None)
+    simulator.chat_doctor = chat
+    if not simulator.diagnosis_finished:
+        logger.warning("Simulation did not finish with a diagnosis.")
+        return None
+    return simulator.extract_diagnoses()
+
+
+async def ascore_chat(chat: "CChat", vignette: "Vignette", judge: Optional[Judge] = None) -> float:
+    """Position of the correct diagnosis of <vignette> in <chat>, or -2 if unfinished."""
+    obtained_diagnoses = _extract_diagnoses(chat, vignette)
+    if obtained_diagnoses is None:
+        return -2
+    return await aget_score(obtained_diagnoses, vignette.correct_diagnosis, judge)
 
+
+def _summarize(positions: List[List[float]]) -> Dict[int, Dict[str, Any]]:
+    """:return: For each experiment, a dict of experiment results."""
+    results: Dict[int, Dict[str, Any]] = {}
+    for i, experiment_positions in enumerate(positions):
         logger.info(f"Results of run {i=}")
-        goods = [p for p in positions if p >= 1]  # Positions of correct diagnoses.
+        goods = [p for p in experiment_positions if p >= 1]  # Positions of correct diagnoses.
         avg_position = sum(goods) / len(goods) if goods else -1
-        print(f"\tpositions={positions}")
-        print(f"\tNumber of correct diagnoses: {len(goods)} / {len(positions)}")
+        print(f"\tpositions={experiment_positions}")
+        print(f"\tNumber of correct diagnoses: {len(goods)} / {len(experiment_positions)}")
         print(f"\tAverage position of correct diagnosis: {avg_position}")
         print("\n\n")
-        results[i]["n_correct"] = len(goods)
-        results[i]["positions"] = positions
-
+        results[i] = {"n_correct": len(goods), "positions": experiment_positions}
+    _log_intervals(positions)
     return results
+
+
+def _log_intervals(positions: List[List[float]], ks: Tuple[int, ...] = (1, 3, 5)) -> None:
+    """
+    Log top-k accuracies over all experiments, with 95% bootstrap intervals resampling the
+    vignettes together with their chats in every experiment.
+    """
+    flat = [
+        (j, p) for experiment_positions in positions for j, p in enumerate(experiment_positions)
+    ]
+    if not flat:
+        return
+    vignettes = [j for j, _ in flat]
+    hits = [[1 <= p <= k for _, p in flat] for k in ks]
+    for k, interval in zip(ks, bootstrap_ratios(hits, clusters=vignettes)):
+        logger.info(f"Top-{k} accuracy over all experiments: {format_interval(interval)}")
+
+
+async def aevaluate(
+    result: ExperimentResult, max_workers: Optional[int] = None, judge: Optional[Judge] = None
+) -> Dict[int, Dict[str, Any]]:
+    """
+    Score all chats of <result> concurrently, then summarize them.
+    :param max_workers: Maximum number of chats scored at once. The number of requests
+        in flight is also adapted to the judge backend by its rate limiter.
+    :param judge: Judge scoring the chats, by default unbatched and uncached.
+    :return: For each experiment from <num_experiments>, a dict of experiment results.
+    """
+    result = result.copy()  # Make sure we don't accidentally modify the results.
+    judge = judge or Judge()
+    keys = [(i, j) for i in range(result.num_experiments) for j in range(len(result.vignettes))]
+    params = [
+        {"chat": result.chats[i][j], "vignette": result.vignettes[j], "judge": judge}
+        for i, j in keys
+    ]
+    scores = await aexec_concurrently(ascore_chat, params, max_workers=max_workers)
+    judge.report()
+
+    positions: List[List[float]] = [[] for _ in range(result.num_experiments)]
+    for (i, _), score in zip(keys, scores):
+        positions[i].append(score)
+    return _summarize(positions)
+
+
+def evaluate(
+    result: ExperimentResult, max_workers: Optional[int] = None, judge: Optional[Judge] = None
+) -> Dict[int, Dict[str, Any]]:
+    """
+    Evaluation, scoring all chats concurrently on a single event loop.
+    :return: For each experiment from <num_experiments>, a dict of experiment results.
+    """
+    return asyncio.run(aevaluate(result, max_workers, judge))
+
+
+class PipelinedEvaluator:
+    """
+    Score the chats of <result> while the simulation is still running, so the judge calls
+    overlap with the remaining simulations. Must be used from within the event loop of
+    the simulation: submit() each chat as soon as its simulation finished, then await
+    results() once all simulations are done.
+    :param judge: Judge scoring the chats, by default unbatched and uncached.
+    :param on_score: Called with the experiment, the vignette and the score of each chat as
+        soon as it is scored.
+    """
+
+    def __init__(
+        self,
+        result: ExperimentResult,
+        judge: Optional[Judge] = None,
+        on_score: Optional[Callable[[int, int, float], None]] = None,
+    ) -> None:
+        self.result = result
+        self.judge = judge or Judge()
+        self.on_score = on_score
+        self._tasks: Dict[Tuple[int, int], "asyncio.Task[float]"] = {}
+
+    def submit(self, experiment: int, vignette: int) -> None:
+        """Start scoring the chat of <vignette> in <experiment>."""
+        chat = self.result.chats[experiment][vignette]
+        coro = ascore_chat(chat, self.result.vignettes[vignette], self.judge)
+        task = asyncio.create_task(coro)
+        if self.on_score is not None:
+            task.add_done_callback(partial(self._scored, experiment, vignette))
+        self._tasks[(experiment, vignette)] = task
+
+    def _scored(self, experiment: int, vignette: int, task: "asyncio.Task[float]") -> None:
+        if not task.cancelled() and task.exception() is None:
+            self.on_score(experiment, vignette, task.result())
+
+    async def results(self, vignettes: Optional[List[int]] = None) -> Dict[int, Dict[str, Any]]:
+        """
+        Wait for all scores, scoring the chats that were never submitted as well.
+        :param vignettes: Only evaluate the chats of these vignettes, by default all of them.
+        :return: For each experiment from <num_experiments>, a dict of experiment results.
+        """
+        if vignettes is None:
+            vignettes = list(range(len(self.result.vignettes)))
+        for i in range(self.result.num_experiments):
+            for j in vignettes:
+                if (i, j) not in self._tasks:
+                    self.submit(i, j)
+        keys = [(i, j) for i in range(self.result.num_experiments) for j in vignettes]
+        scores = await asyncio.gather(*(self._tasks[k] for k in keys))
+        self.judge.report()
+        by_key = dict(zip(keys, scores))
+        return _summarize(
+            [[by_key[(i, j)] for j in vignettes] for i in range(self.result.num_experiments)]
+        )
+
+
+def _needs_evaluation(path: str, config: Dict[str, Any]) -> bool:
+    """True unless <path> was evaluated by a judge with <config>, checked without its chats."""
+    try:
+        with LazyExperimentResult(path) as result:
+            return not result.evaluation or result.field("evaluation_config") != config
+    except (ValueError, KeyError, OSError) as e:
+        logger.warning(f"Skipping unreadable result {path}: {e}")
+        return False
+
+
+async def aevaluate_files(
+    paths: List[str], judge: Judge, load_workers: Optional[int] = None, force: bool = False
+) -> None:
+    """
+    Evaluate the results stored in <paths> with <judge>, writing each evaluation back as
+    soon as it is done. Results already evaluated by a judge with the same configuration
+    are skipped, unless <force>. Results are loaded in a process pool while the chats of
+    those already loaded are scored, all through the concurrency limits of <judge>.
+    """
+    config = judge.config
+    todo = [path for path in paths if force or _needs_evaluation(path, config)]
+    logger.info(f"Evaluating {len(todo)} of {len(paths)} results with {config}")
+    loop = asyncio.get_running_loop()
+
+    with ProcessPoolExecutor(max_workers=load_workers) as pool:
+
+        async def _evaluate(path: str) -> None:
+            result = await loop.run_in_executor(pool, ExperimentResult.load, path)
+            result.evaluation = await aevaluate(result, judge=judge)
+            result.evaluation_config = config
+            result.dump(path)
+            logger.info(f"Wrote evaluation of {path}")
+
+        await asyncio.gather(*(_evaluate(path) for path in todo))
+    judge.report()
+
+
+def get_args() -> ArgumentParser:
+    parser = ArgumentParser(description="Evaluate stored SymptomCheck results")
+    parser.add_argument(
+        "results",
+        type=str,
+        nargs="+",
+        help="Result files or sharded result directories, as glob patterns.",
+    )
+    parser.add_argument("--evaluator_llm", type=str, default=DEFAULT_EVALUATOR)
+    parser.add_argument(
+        "--evaluator_concurrency",
+        type=int,
+        default=None,
+        help="Maximum number of evaluator requests in flight, across all results. Other "
+        "calls to the evaluator model are not limited by it, but share its rate limits.",
+    )
+    parser.add_argument("--judge_batch_size", type=int, default=1)
+    parser.add_argument("--local_match", action="store_true")
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=None,
+        help="Optional path to a SQLite file caching judge verdicts.",
+    )
+    parser.add_argument(
+        "--load_workers",
+        type=int,
+        default=None,
+        help="Number of processes loading result files (default: number of CPUs).",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Evaluate again results already evaluated with the same judge configuration.",
+    )
+    return parser
+
+
+def main(args: ArgumentParser) -> None:
+    args = args.parse_args()
+    paths = sorted({path for pattern in args.results for path in glob.glob(pattern)})
+    paths = [p for p in paths if p.endswith(".json") or os.path.isfile(f"{p}/{MANIFEST}")]
+
+    judge = Judge(
+        model_to_client(args.evaluator_llm),
+        concurrency=args.evaluator_concurrency,
+        batch_size=args.judge_batch_size,
+        cache=SqliteCache(args.cache) if args.cache else None,
+        matcher=DiagnosisMatcher.from_icd_eval() if args.local_match else None,
+    )
+    asyncio.run(aevaluate_files(paths, judge, args.load_workers, args.force))
+
+
+if __name__ == "__main__":
+    args = get_args()
+    main(args)
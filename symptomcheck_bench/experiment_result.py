@@ -1,9 +1,10 @@
 import json
 import os
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from logging import getLogger
+from typing import Any, Dict, List, Optional, Set, Tuple
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
 from medask.models.comms.models import CChat
 
@@ -12,6 +13,10 @@ from medask.benchmark.vignette import (
     Vignette,
 )
 
+logger = getLogger("benchmark.experiment_result")
+
+MANIFEST = "manifest.json"
+
 
 class ExperimentResult(BaseModel):
     """
@@ -24,6 +29,12 @@ class ExperimentResult(BaseModel):
     :param result_name_suffix: Add a suffix to the filename where this result is stored.
     :param evaluation: Stores result of benchmark.evaluate. This is just a simple dict,
         so it will always be backward compatible.
+    :param evaluation_config: Configuration of the judge that produced <evaluation>, so
+        results are not evaluated again with the same judge.
+    :param storage: "file" dumps everything to a single JSON file at <dump_path>, rewritten
+        at each dump. "sharded" dumps to the directory <shard_dir>: a small manifest with
+        everything but the chats, rewritten at each dump, and one JSONL shard per experiment
+        to which each chat is appended once, so a dump only costs the new data.
     """
 
     vignette_file: str
@@ -37,29 +48,143 @@ class ExperimentResult(BaseModel):
     comment: Optional[str] = None
     result_name_suffix: str = ""
     evaluation: Dict[Any, Any] = {}
+    evaluation_config: Dict[str, Any] = {}
+    storage: str = "file"
+
+    # (experiment, vignette) of the chats already appended to the shards.
+    _dumped: Set[Tuple[int, int]] = PrivateAttr(default_factory=set)
 
     @property
     def dump_path(self) -> str:
         dt = self.dt.isoformat(timespec="seconds")
         suffix = f"_{self.result_name_suffix}" if self.result_name_suffix else ""
-        name = f"{dt}_{self.doctor_llm}_{len(self.chats[0])}{suffix}.json"
+        name = f"{dt}_{self.doctor_llm}_{len(self.vignettes)}{suffix}.json"
         if "http" in self.doctor_llm:
             name = name.replace(self.doctor_llm, "LOCAL_LLM")
         directory = os.path.dirname(os.path.abspath(__file__))
         return f"{directory}/results/{name}"
 
-    def dump(self) -> None:
-        with open(self.dump_path, "w") as f:
-            f.write(self.model_dump_json())
+    @property
+    def shard_dir(self) -> str:
+        return self.dump_path.removesuffix(".json")
+
+    def _shard_path(self, experiment: int) -> str:
+        return os.path.join(self.shard_dir, f"chats_{experiment}.jsonl")
+
+    def dump(self, path: Optional[str] = None) -> None:
+        """
+        Dump to <path>, by default self.dump_path, or self.shard_dir if sharded.
+        For a sharded result, <path> must be the directory it was loaded from: its chats are
+        stored already, so only the manifest is rewritten.
+        """
+        if self.storage == "sharded" and path is not None:
+            self.dump_manifest(path)
+        elif self.storage == "sharded":
+            for i, chats in enumerate(self.chats):
+                for j in range(len(chats)):
+                    if (i, j) not in self._dumped:
+                        self.dump_chat(i, j)
+            self.dump_manifest()
+        else:
+            with open(path or self.dump_path, "w") as f:
+                f.write(self.model_dump_json())
+
+    def dump_manifest(self, directory: Optional[str] = None) -> None:
+        """Atomically rewrite the manifest of the sharded storage, everything but the chats."""
+        directory = directory or self.shard_dir
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, MANIFEST)
+        with open(f"{path}.tmp", "w") as f:
+            f.write(self.model_dump_json(exclude={"chats"}))
+        os.replace(f"{path}.tmp", path)
+
+    def dump_chat(self, experiment: int, vignette: int) -> None:
+        """
+        Append the chat of <vignette> in <experiment> to the shard of the experiment.
+        Appending a chat again supersedes the earlier record when loading.
+        """
+        os.makedirs(self.shard_dir, exist_ok=True)
+        chat = self.chats[experiment][vignette]
+        record = {"vignette": vignette, "chat": chat.model_dump(mode="json")}
+        # A crash can leave a partial record, which must not be continued by this one.
+        truncate_torn_tail(self._shard_path(experiment))
+        with open(self._shard_path(experiment), "a") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._dumped.add((experiment, vignette))
+
+    def select_vignettes(self, keep: List[int]) -> None:
+        """Keep only the vignettes at positions <keep>, with their chats, dropping the rest."""
+        self.vignettes = [self.vignettes[j] for j in keep]
+        self.vignette_indices = [self.vignette_indices[j] for j in keep]
+        self.chats = [[chats[j] for j in keep] for chats in self.chats]
+
+    def mark_dumped(self, experiment: int, vignette: int) -> None:
+        """Record that the chat of <vignette> in <experiment> is already in its shard."""
+        self._dumped.add((experiment, vignette))
+
+    @classmethod
+    def from_raw(cls, raw: Dict[str, Any]) -> "ExperimentResult":
+        """Make an ExperimentResult from its parsed JSON, as written by self.dump()."""
+        # Transform str indices into ints, like '0' into 0.
+        for exp_ix in [k for k in raw.get("evaluation", {})]:
+            evaluation = raw["evaluation"].pop(exp_ix)
+            raw["evaluation"][int(exp_ix)] = evaluation
+        vignette_cls = AveyVignette if raw["vignette_file"] == "avey" else None
+        raw["vignettes"] = [vignette_cls(**d) for d in raw["vignettes"]]
+        return ExperimentResult(**raw)
 
     @classmethod
     def load(cls, path: str) -> "ExperimentResult":
+        """Load a result dumped to a single file, or to the sharded directory <path>."""
+        if os.path.isdir(path):
+            return cls._load_sharded(path)
         with open(path) as f:
             raw = json.load(f)
-            # Transform str indices into ints, like '0' into 0.
-            for exp_ix in [k for k in raw["evaluation"]]:
-                evaluation = raw["evaluation"].pop(exp_ix)
-                raw["evaluation"][int(exp_ix)] = evaluation
-            cls = AveyVignette if raw["vignette_file"] == "avey" else None
-            raw["vignettes"] = [cls(**d) for d in raw["vignettes"]]
-        return ExperimentResult(**raw)
+        return cls.from_raw(raw)
+
+    @classmethod
+    def _load_sharded(cls, directory: str) -> "ExperimentResult":
+        with open(os.path.join(directory, MANIFEST)) as f:
+            raw = json.load(f)
+        n_vignettes = len(raw["vignettes"])
+        raw["chats"] = []
+        dumped = set()
+        for i in range(raw["num_experiments"]):
+            chats: List[Optional[dict]] = [None] * n_vignettes
+            for record in read_shard(os.path.join(directory, f"chats_{i}.jsonl")):
+                chats[record["vignette"]] = record["chat"]
+                dumped.add((i, record["vignette"]))
+            if any(c is None for c in chats):
+                logger.warning(f"Experiment {i} of {directory} is missing chats, left empty.")
+            # A missing chat is left empty, so it is evaluated as unfinished.
+            raw["chats"].append([c or {"user_id": 5, "messages": []} for c in chats])
+        result = cls.from_raw(raw)
+        # Missing chats are not in the shards yet, so the next dump appends them.
+        result._dumped = dumped
+        return result
+
+
+def truncate_torn_tail(path: str) -> None:
+    """Truncate a partially written last record of the JSONL file <path>, if there is one."""
+    if not os.path.exists(path):
+        return
+    with open(path, "r+b") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        f.seek(0)
+        end = f.read().rfind(b"\n") + 1
+        logger.warning(f"Truncating torn record at byte {end} of {path}")
+        f.truncate(end)
+
+
+def read_shard(path: str) -> List[Dict[str, Any]]:
+    """Records of the JSONL shard in <path>, truncating a partially written last one."""
+    if not os.path.exists(path):
+        return []
+    truncate_torn_tail(path)
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,149 @@
+import json
+import os
+from logging import getLogger
+from threading import Lock
+from typing import TYPE_CHECKING, Any, Dict, List, Set, Tuple
+
+from medask.models.comms.models import CMessage
+
+from medask.benchmark.experiment_result import ExperimentResult
+
+if TYPE_CHECKING:
+    from medask.benchmark.simulator import Simulator
+
+logger = getLogger("benchmark.journal")
+
+# A conversation is identified by the index of its experiment and of its vignette.
+Key = Tuple[int, int]
+
+
+class Journal:
+    """
+    Append-only log of a symptomcheck run in <path>, one JSON line per record, fsynced as
+    soon as it is written. The first record holds the ExperimentResult of the run without
+    chats. Then every turn of every conversation gets a record with the messages it added
+    to chat_doctor and chat_patient, and a finished conversation gets a final "done" record.
+    Replaying the journal rebuilds every conversation up to its last completed turn, so an
+    interrupted run can be resumed. A partially written last record is dropped on load.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = Lock()
+        self._messages: Dict[Key, Tuple[List[dict], List[dict]]] = {}
+        self._done: Set[Key] = set()
+        # Lengths of chat_doctor and chat_patient of each conversation covered by the journal.
+        self._journaled: Dict[Key, Tuple[int, int]] = {}
+        self._header: Dict[str, Any] = {}
+        self._file = None
+
+    @staticmethod
+    def path_for(result: ExperimentResult) -> str:
+        return result.dump_path.removesuffix(".json") + ".journal.jsonl"
+
+    @classmethod
+    def create(cls, result: ExperimentResult) -> "Journal":
+        """Start the journal of a new run of <result>."""
+        journal = cls(cls.path_for(result))
+        journal._header = result.model_dump(mode="json", exclude={"chats", "evaluation"})
+        journal._file = open(journal.path, "w", encoding="utf-8")
+        journal._write({"type": "run", "result": journal._header})
+        return journal
+
+    @classmethod
+    def open(cls, path: str) -> "Journal":
+        """Load the journal in <path> to resume its run, and keep appending to it."""
+        journal = cls(path)
+        journal._load()
+        journal._file = open(path, "a", encoding="utf-8")
+        return journal
+
+    def _load(self) -> None:
+        with open(self.path, "rb") as f:
+            data = f.read()
+        lines = data.split(b"\n")
+        offset = 0
+        for i, line in enumerate(lines):
+            last = i == len(lines) - 1
+            try:
+                if last and line:
+                    raise ValueError("Record not terminated by a newline.")
+                if line:
+                    self._replay(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                if not last:
+                    raise ValueError(f"Corrupt record {i} in journal {self.path}: {e}") from e
+                logger.warning(f"Truncating torn record at byte {offset} of {self.path}: {e}")
+                with open(self.path, "r+b") as f:
+                    f.truncate(offset)
+            offset += len(line) + 1
+        if not self._header:
+            raise ValueError(f"Journal {self.path} has no run record.")
+
+    def _replay(self, record: Dict[str, Any]) -> None:
+        if record["type"] == "run":
+            self._header = record["result"]
+            return
+        key = (record["experiment"], record["vignette"])
+        if record["type"] == "turn":
+            doctor, patient = self._messages.setdefault(key, ([], []))
+            doctor.extend(record["doctor"])
+            patient.extend(record["patient"])
+        elif record["type"] == "done":
+            self._done.add(key)
+        else:
+            raise ValueError(f"Unknown record type {record['type']}")
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+    def discard(self) -> None:
+        """Close and delete the journal, once the result of its run is stored."""
+        self.close()
+        os.remove(self.path)
+        logger.info(f"Removed the journal {self.path} of the finished run")
+
+    @property
+    def result(self) -> ExperimentResult:
+        """The ExperimentResult of the run, with no chats."""
+        return ExperimentResult.from_raw({**self._header, "chats": []})
+
+    def is_done(self, key: Key) -> bool:
+        return key in self._done
+
+    def restore(self, key: Key, simulator: "Simulator") -> None:
+        """
+        Append the journaled messages of conversation <key> to the chats of <simulator>.
+        Must be called for each simulator before its turns are recorded.
+        """
+        doctor, patient = self._messages.get(key, ([], []))
+        simulator.chat_doctor.messages.extend(CMessage(**m) for m in doctor)
+        simulator.chat_patient.messages.extend(CMessage(**m) for m in patient)
+        self._journaled[key] = (len(simulator.chat_doctor), len(simulator.chat_patient))
+
+    def record_turn(self, key: Key, simulator: "Simulator") -> None:
+        """Journal the messages <simulator> added to its chats since the last record."""
+        n_doctor, n_patient = self._journaled[key]
+        doctor = simulator.chat_doctor.messages[n_doctor:]
+        patient = simulator.chat_patient.messages[n_patient:]
+        self._write(
+            {
+                "type": "turn",
+                "experiment": key[0],
+                "vignette": key[1],
+                "doctor": [m.model_dump(mode="json") for m in doctor],
+                "patient": [m.model_dump(mode="json") for m in patient],
+            }
+        )
+        self._journaled[key] = (len(simulator.chat_doctor), len(simulator.chat_patient))
+
+    def record_done(self, key: Key) -> None:
+        self._write({"type": "done", "experiment": key[0], "vignette": key[1]})
+        self._done.add(key)
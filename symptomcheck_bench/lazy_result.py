@@ -0,0 +1,222 @@
+import json
+import mmap
+import os
+import re
+from datetime import datetime
+from logging import getLogger
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from medask.models.comms.models import CChat
+
+from medask.benchmark.experiment_result import MANIFEST, ExperimentResult
+from medask.benchmark.vignette import AveyVignette, Vignette
+
+logger = getLogger("benchmark.lazy_result")
+
+_WS = re.compile(rb"\s*")
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_SCALAR = re.compile(rb"[^,\]}\s]+")
+# Strings and brackets, the only tokens that matter to find where a JSON value ends.
+_TOKEN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]', re.DOTALL)
+
+Span = Tuple[int, int]
+
+
+def _skip_ws(buf: Any, pos: int) -> int:
+    return _WS.match(buf, pos).end()
+
+
+def _skip_value(buf: Any, pos: int) -> int:
+    """Offset right after the JSON value starting at <pos> of <buf>, without parsing it."""
+    c = buf[pos : pos + 1]
+    if c == b'"':
+        return _STRING.match(buf, pos).end()
+    if c not in (b"{", b"["):
+        return _SCALAR.match(buf, pos).end()
+    depth = 0
+    for m in _TOKEN.finditer(buf, pos):
+        c = buf[m.start() : m.start() + 1]
+        if c in (b"{", b"["):
+            depth += 1
+        elif c in (b"}", b"]"):
+            depth -= 1
+            if depth == 0:
+                return m.end()
+    raise ValueError(f"Unterminated JSON value at byte {pos}")
+
+
+def _object_spans(buf: Any, pos: int) -> Dict[str, Span]:
+    """Spans of the values of the JSON object starting at <pos>, by key."""
+    spans = {}
+    pos = _skip_ws(buf, pos + 1)
+    while buf[pos : pos + 1] != b"}":
+        m = _STRING.match(buf, pos)
+        key = json.loads(m.group())
+        pos = _skip_ws(buf, m.end())
+        pos = _skip_ws(buf, pos + 1)  # The colon.
+        end = _skip_value(buf, pos)
+        spans[key] = (pos, end)
+        pos = _skip_ws(buf, end)
+        if buf[pos : pos + 1] == b",":
+            pos = _skip_ws(buf, pos + 1)
+    return spans
+
+
+def _array_spans(buf: Any, span: Span) -> List[Span]:
+    """Spans of the items of the JSON array in <span>."""
+    spans = []
+    pos = _skip_ws(buf, span[0] + 1)
+    while buf[pos : pos + 1] != b"]":
+        end = _skip_value(buf, pos)
+        spans.append((pos, end))
+        pos = _skip_ws(buf, end)
+        if buf[pos : pos + 1] == b",":
+            pos = _skip_ws(buf, pos + 1)
+    return spans
+
+
+class LazyExperimentResult:
+    """
+    Read-only view of an ExperimentResult dumped to <path>, a single JSON file or a sharded
+    directory, that only parses what is accessed. The file is memory mapped and indexed by a
+    scan for strings and brackets, so metadata like <evaluation> is available without
+    validating any vignette or chat, and chats are built one at a time on demand.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._sharded = os.path.isdir(path)
+        self._mmap: Optional[mmap.mmap] = None
+        self._spans: Dict[str, Span] = {}
+        self._manifest: Dict[str, Any] = {}
+        # Spans of each chat in the file, or in the shard, per experiment.
+        self._chat_spans: Optional[List[List[Optional[Span]]]] = None
+        self._vignettes: Optional[List[Vignette]] = None
+
+        if self._sharded:
+            with open(os.path.join(path, MANIFEST)) as f:
+                self._manifest = json.load(f)
+        else:
+            with open(path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._spans = _object_spans(self._mmap, _skip_ws(self._mmap, 0))
+
+    def __enter__(self) -> "LazyExperimentResult":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def field(self, name: str, default: Any = None) -> Any:
+        """Parse the top-level field <name>, which should not be one of the big ones."""
+        if self._sharded:
+            return self._manifest.get(name, default)
+        if name not in self._spans:
+            return default
+        start, end = self._spans[name]
+        return json.loads(self._mmap[start:end])
+
+    @property
+    def vignette_file(self) -> str:
+        return self.field("vignette_file")
+
+    @property
+    def vignette_indices(self) -> List[int]:
+        return self.field("vignette_indices")
+
+    @property
+    def num_experiments(self) -> int:
+        return self.field("num_experiments")
+
+    @property
+    def doctor_llm(self) -> str:
+        return self.field("doctor_llm")
+
+    @property
+    def patient_llm(self) -> str:
+        return self.field("patient_llm")
+
+    @property
+    def dt(self) -> datetime:
+        return datetime.fromisoformat(self.field("dt"))
+
+    @property
+    def comment(self) -> Optional[str]:
+        return self.field("comment")
+
+    @property
+    def evaluation(self) -> Dict[int, Dict[str, Any]]:
+        return {int(k): v for k, v in self.field("evaluation", {}).items()}
+
+    @property
+    def vignettes(self) -> List[Vignette]:
+        if self._vignettes is None:
+            vignette_cls = AveyVignette if self.vignette_file == "avey" else None
+            self._vignettes = [vignette_cls(**d) for d in self.field("vignettes")]
+        return self._vignettes
+
+    def _index_chats(self) -> List[List[Optional[Span]]]:
+        if self._chat_spans is not None:
+            return self._chat_spans
+        if not self._sharded:
+            experiments = _array_spans(self._mmap, self._spans["chats"])
+            self._chat_spans = [_array_spans(self._mmap, span) for span in experiments]
+            return self._chat_spans
+
+        n_vignettes = len(self.vignette_indices)
+        self._chat_spans = []
+        for i in range(self.num_experiments):
+            spans: List[Optional[Span]] = [None] * n_vignettes
+            offset = 0
+            path = os.path.join(self.path, f"chats_{i}.jsonl")
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    for line in f:
+                        # A later record of the same chat supersedes earlier ones.
+                        if line.endswith(b"\n"):
+                            record = _object_spans(line, _skip_ws(line, 0))
+                            start, end = record["chat"]
+                            vignette = json.loads(line[slice(*record["vignette"])])
+                            spans[vignette] = (offset + start, offset + end)
+                        offset += len(line)
+            self._chat_spans.append(spans)
+        return self._chat_spans
+
+    def _read_chat(self, experiment: int, span: Optional[Span]) -> CChat:
+        if span is None:
+            # A chat missing from its shard is evaluated as unfinished, as in ExperimentResult.
+            return CChat(user_id=5, messages=[])
+        start, end = span
+        if not self._sharded:
+            return CChat.model_validate_json(self._mmap[start:end])
+        with open(os.path.join(self.path, f"chats_{experiment}.jsonl"), "rb") as f:
+            f.seek(start)
+            return CChat.model_validate_json(f.read(end - start))
+
+    def chat(self, experiment: int, vignette: int) -> CChat:
+        """The chat of the <vignette>-th vignette in <experiment>."""
+        return self._read_chat(experiment, self._index_chats()[experiment][vignette])
+
+    def iter_chats(self, experiment: int) -> Iterator[CChat]:
+        """The chats of <experiment> in the order of the vignettes, built one at a time."""
+        for span in self._index_chats()[experiment]:
+            yield self._read_chat(experiment, span)
+
+    def load(self) -> ExperimentResult:
+        """Load the whole ExperimentResult."""
+        return ExperimentResult.load(self.path)
+
+
+def iter_results(directory: str) -> Iterator[LazyExperimentResult]:
+    """Lazily open every result in <directory>, both single files and sharded directories."""
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith(".json") or os.path.isfile(os.path.join(path, MANIFEST)):
+            try:
+                yield LazyExperimentResult(path)
+            except (ValueError, KeyError, AttributeError, OSError) as e:
+                logger.warning(f"Skipping unreadable result {path}: {e}")
@@ -1,17 +1,22 @@
+import asyncio
 import logging
 from argparse import ArgumentParser
+from functools import partial
 from random import sample
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set
 
-from medask.ummon.anthropic import UmmonAnthropic
+from medask.ummon.cached import UmmonCached
 from medask.ummon.local_llm import UmmonLocalLLM
-from medask.ummon.koboldcpp import UmmonKoboldCPP
-from medask.util.concurrency import exec_concurrently
+from medask.util.cache import SqliteCache
 from medask.util.decorator import timeit
 from medask.util.log import get_logger
 
-from medask.benchmark.evaluate import evaluate
+from medask.benchmark.evaluate import Judge, PipelinedEvaluator
 from medask.benchmark.experiment_result import ExperimentResult
+from medask.benchmark.journal import Journal
+from medask.benchmark.matcher import DiagnosisMatcher
+from medask.benchmark.scheduler import TurnScheduler
+from medask.benchmark.sequential import SequentialStop, reference_hits
 from medask.benchmark.simulator import LocalSimulator, NaiveSimulator
 from medask.benchmark.util import LLMClient, model_to_client
 from medask.benchmark.vignette import (
@@ -28,57 +33,190 @@ logging.getLogger("ummon.koboldcpp").setLevel(logging.WARNING)
 logging.getLogger("ummon.mistral").setLevel(logging.WARNING)
 logging.getLogger("ummon.openai").setLevel(logging.WARNING)
 
+# Conversations in progress at once with --target_ci_width, if not given. The more are in
+# progress, the more are started before the scores of the first ones are known.
+TARGET_MAX_ACTIVE = 16
 
-@timeit(logger, log_kwargs=False)
-def run_experiment(
-    vignettes: List["Vignette"], doctor_client: LLMClient, patient_client: LLMClient
+
+def make_simulators(
+    vignettes: List["Vignette"],
+    doctor_client: LLMClient,
+    patient_client: LLMClient,
+    cache: Optional[SqliteCache] = None,
+    experiment: int = 0,
 ) -> List["Simulator"]:
     """
-    Make a Simulator object for each vignette and use them to simulate the diagnoses.
-    Execute them concurrently for speedup.
+    Make a Simulator object for each vignette.
+    :param cache: If given, LLM completions are looked up in and stored to the cache.
+    :param experiment: Index of the experiment. Each experiment samples new conversations,
+        so it gets its own namespace in the cache.
     """
-    simulators = []
     if isinstance(doctor_client, UmmonLocalLLM):
         simulator_cls = LocalSimulator
     else:
         simulator_cls = NaiveSimulator
 
-    # Initialise simulator with a vignette and new instances of clients.
-    for v in vignettes:
-        simulator = simulator_cls(
-            vignette=v,
-            doctor_client=type(doctor_client)(model=doctor_client._model),
-            patient_client=type(patient_client)(model=patient_client._model),
-        )
-        simulators.append(simulator)
+    if cache is not None:
+        doctor_client = UmmonCached(doctor_client, cache, namespace=f"experiment{experiment}")
+        patient_client = UmmonCached(patient_client, cache, namespace=f"experiment{experiment}")
 
-    # Some clients cannot be run concurrently because of rate limiting.
-    max_workers = 10
-    for client in (doctor_client, patient_client):
-        if isinstance(client, (UmmonAnthropic)):
-            max_workers = 2
-        elif isinstance(client, (UmmonLocalLLM, UmmonKoboldCPP)):
-            max_workers = 1
+    # Initialise simulator with a vignette. Clients are stateless so they can be shared.
+    return [
+        simulator_cls(vignette=v, doctor_client=doctor_client, patient_client=patient_client)
+        for v in vignettes
+    ]
 
-    # Concurrently call .simulate() on each of the simulators.
-    params = [{} for _ in simulators]
-    exec_concurrently([s.simulate for s in simulators], params, max_workers)
+
+@timeit(logger, log_kwargs=False)
+def run_experiment(
+    vignettes: List["Vignette"],
+    doctor_client: LLMClient,
+    patient_client: LLMClient,
+    cache: Optional[SqliteCache] = None,
+    experiment: int = 0,
+) -> List["Simulator"]:
+    """
+    Make a Simulator object for each vignette and use them to simulate the diagnoses.
+    Execute them concurrently on a single event loop for speedup.
+    """
+    simulators = make_simulators(vignettes, doctor_client, patient_client, cache, experiment)
+    asyncio.run(TurnScheduler().run([simulators]))
 
     # Return simulators, which contain chats in attributes (self.chat_doctor).
     return simulators
 
 
+@timeit(logger, log_kwargs=False)
+def run_experiments(
+    result: ExperimentResult,
+    doctor_client: LLMClient,
+    patient_client: LLMClient,
+    cache: Optional[SqliteCache] = None,
+    max_active: Optional[int] = None,
+    journal: Optional[Journal] = None,
+    score: bool = False,
+    judge: Optional[Judge] = None,
+    stop: Optional[SequentialStop] = None,
+) -> Optional[Dict[int, Dict[str, Any]]]:
+    """
+    Simulate all <result.num_experiments> experiments over <result.vignettes> at once, with
+    the turns of all conversations interleaved by a TurnScheduler. This keeps the doctor and
+    the patient backends busy at the same time instead of one experiment after the other.
+    <result.chats> holds the chats of every experiment as they progress and <result> is
+    dumped each time an experiment completes, so partial results survive an error midway.
+    :param max_active: Maximum number of conversations in progress at once.
+    :param journal: If given, every turn is recorded to it. Conversations already in it are
+        restored first, and only the unfinished ones are simulated further.
+    :param score: If True, each chat is evaluated as soon as its conversation finished,
+        overlapping the judge calls with the remaining simulations.
+    :param judge: Judge used to score the chats, by default unbatched and uncached.
+    :param stop: If given, vignettes are started in the order of <result.vignettes>, each
+        with all its experiments, and no new vignette is started once <stop> is reached.
+        <result> is then cut down to the vignettes that were started. Requires <score>.
+    :return: The evaluation of <result> if <score>, else None.
+    """
+    groups = [
+        make_simulators(result.vignettes, doctor_client, patient_client, cache, i)
+        for i in range(result.num_experiments)
+    ]
+    result.chats = [[s.chat_doctor for s in simulators] for simulators in groups]
+
+    todo = groups
+    if journal is not None:
+        for i, simulators in enumerate(groups):
+            for j, simulator in enumerate(simulators):
+                journal.restore((i, j), simulator)
+                simulator.on_turn = partial(journal.record_turn, (i, j), simulator)
+        todo = [
+            [s for j, s in enumerate(simulators) if not journal.is_done((i, j))]
+            for i, simulators in enumerate(groups)
+        ]
+        n_done = sum(len(g) for g in groups) - sum(len(g) for g in todo)
+        if n_done:
+            logger.info(f"Resuming from {journal.path}, skipping {n_done} finished conversations")
+        # Finished conversations are not simulated again, but still need their chat ids.
+        # They were stored before being journaled as done, so are not stored again.
+        for i, simulators in enumerate(groups):
+            for j, simulator in enumerate(simulators):
+                if journal.is_done((i, j)):
+                    simulator.set_chat_ids()
+                    result.mark_dumped(i, j)
+
+    indices = {id(s): j for simulators in groups for j, s in enumerate(simulators)}
+    on_score = (lambda i, j, position: stop.add(j, position)) if stop is not None else None
+    evaluator = PipelinedEvaluator(result, judge, on_score) if score else None
+    started: Set[int] = set()
+
+    def _should_start(i: int, simulator: "Simulator") -> bool:
+        j = indices[id(simulator)]
+        if j not in started:
+            if stop.reached():
+                return False
+            started.add(j)
+        return True
+
+    def _on_conversation_done(i: int, simulator: "Simulator") -> None:
+        j = indices[id(simulator)]
+        if result.storage == "sharded":
+            result.dump_chat(i, j)
+        # Only marked done once stored, so a crash in between resumes the conversation.
+        if journal is not None and simulator.finished:
+            journal.record_done((i, j))
+        if evaluator is not None:
+            evaluator.submit(i, j)
+
+    def _on_experiment_done(i: int) -> None:
+        if result.storage == "sharded":
+            logger.info(f"Experiment {i} done, results in {result.shard_dir}")
+            result.dump_manifest()
+        else:
+            logger.info(f"Experiment {i} done, dumping results to {result.dump_path}")
+            result.dump()
+
+    async def _run() -> Optional[Dict[int, Dict[str, Any]]]:
+        scheduler = TurnScheduler(max_active=max_active)
+        if stop is None:
+            await scheduler.run(todo, _on_experiment_done, _on_conversation_done)
+            return await evaluator.results() if evaluator is not None else None
+
+        await scheduler.run(
+            todo,
+            _on_experiment_done,
+            _on_conversation_done,
+            should_start=_should_start,
+            interleave=True,
+        )
+        keep = sorted(started)
+        evaluation = await evaluator.results(keep)
+        logger.info(f"Ran {len(keep)} of {len(result.vignettes)} vignettes, {stop.summary()}")
+        result.select_vignettes(keep)
+        return evaluation
+
+    return asyncio.run(_run())
+
+
 def get_args() -> ArgumentParser:
     parser = ArgumentParser(description="Symptom Assessment Simulation")
     models = "gpt-4o, claude-3-haiku-20240307, open-mixtral-8x7b ..."
     parser.add_argument("--doctor_llm", type=str, default="gpt-4o-mini", help=models)
     parser.add_argument("--patient_llm", type=str, default="gpt-4o-mini")
-    parser.add_argument("--evaluator_llm", type=str, default="gpt-4o")
+    parser.add_argument(
+        "--evaluator_llm",
+        type=str,
+        default="gpt-4o",
+        help="Judge of the diagnoses, any model accepted for the doctor, local servers too.",
+    )
+    parser.add_argument(
+        "--evaluator_concurrency",
+        type=int,
+        default=None,
+        help="Maximum number of evaluator requests in flight. It does not limit the doctor "
+        "and patient, even if they use the same model, but they all share its rate limits.",
+    )
     parser.add_argument(
         "--file",
         type=str,
         choices=["avey"],
-        required=True,
         help="Specify 'avey' for AVEY_VIGNETTES (more vignettes choices to come later)",
     )
     parser.add_argument(
@@ -90,6 +228,19 @@ def get_args() -> ArgumentParser:
         default=1,
         help="Number of iterations through the vignettes (default: 1)",
     )
+    parser.add_argument(
+        "--judge_batch_size",
+        type=int,
+        default=1,
+        help="Number of chats judged per evaluator request, sharing one instruction block "
+        "and answered as JSON. 1 judges each chat separately.",
+    )
+    parser.add_argument(
+        "--local_match",
+        action="store_true",
+        help="Score the chats whose first diagnosis trivially is the correct one locally, "
+        "instead of sending every chat to the evaluator. Not yet validated against its verdicts.",
+    )
     parser.add_argument(
         "--comment", type=str, help="Optional comment to include in the experiment result."
     )
@@ -99,50 +250,145 @@ def get_args() -> ArgumentParser:
         default="",
         help="Optional suffex to add to the filename with the experiment result.",
     )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=None,
+        help="Optional path to a SQLite file caching LLM completions and judge verdicts, so "
+        "reruns are free.",
+    )
+    parser.add_argument(
+        "--max_active_conversations",
+        type=int,
+        default=None,
+        help="Maximum number of conversations simulated at once, across all experiments. "
+        "By default all of them are started and the per-backend limiters pace the calls.",
+    )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        choices=["file", "sharded"],
+        default="file",
+        help="'file' rewrites one JSON result file after each experiment. 'sharded' stores a "
+        "manifest and appends each chat once to a per-experiment JSONL shard.",
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        default=None,
+        help="Path to the .journal.jsonl of an interrupted run. Its finished conversations "
+        "are kept and the others continue from their last turn. The settings of the run "
+        "are taken from the journal, so --file, --*_llm, --num_* etc. are ignored.",
+    )
+    parser.add_argument(
+        "--target_ci_width",
+        "--target-ci-width",
+        type=float,
+        default=None,
+        help="Run vignettes in random order, each with all its experiments, and start no new "
+        "one once the 95%% bootstrap interval of top-5 accuracy is at most this wide, e.g. "
+        "0.1. --num_vignettes is then the maximum number of vignettes.",
+    )
+    parser.add_argument(
+        "--reference",
+        type=str,
+        default=None,
+        help="With --target_ci_width, an evaluated result file or sharded directory. The "
+        "interval is then that of the difference in top-5 accuracy from it, paired on the "
+        "vignettes both ran, and vignettes are only drawn from those it ran.",
+    )
 
     return parser
 
 
 def main(args: ArgumentParser) -> None:
-    args = args.parse_args()
+    parser, args = args, args.parse_args()
+    if args.target_ci_width is not None and (args.resume or args.storage == "sharded"):
+        parser.error(
+            "--target_ci_width drops the vignettes it didn't run, so it can't be "
+            "combined with --resume or --storage=sharded"
+        )
+    if args.reference is not None and args.target_ci_width is None:
+        parser.error("--reference is only used with --target_ci_width")
+    reference = None
+    if args.reference is not None:
+        reference_file, reference = reference_hits(args.reference)
+        if reference_file != args.file:
+            parser.error(f"--reference ran over {reference_file} vignettes, not {args.file}")
+
+    if args.resume:
+        journal = Journal.open(args.resume)
+        result = journal.result
+        logger.info(f"Resuming experiment over vignettes {result.vignette_indices}")
+    else:
+        if args.file is None:
+            parser.error("--file is required unless --resume is given")
+        # Get random sample of <num_vignettes> from the right vignette file.
+        vignettes = load_vignettes(args.file)
+        pool = sorted(reference) if reference is not None else list(range(len(vignettes)))
+        num_vignettes = min(args.num_vignettes, len(pool))
+        indices = sample(pool, num_vignettes)
+        if args.target_ci_width is None:
+            indices = sorted(indices)
+        # Vignettes are run in the random order of the sample when stopping early.
+        logger.info(f"Running experiment over vignettes {indices}")
+        vignettes = [vignettes[i] for i in indices]
 
-    # Get random sample of <num_vignettes> from the right vignette file.
-    vignettes = load_vignettes(args.file)
-    num_vignettes = min(args.num_vignettes, len(vignettes))
-    indices = sorted(sample(list(range(len(vignettes))), num_vignettes))
-    logger.info(f"Running experiment over vignettes {indices}")
-    vignettes = [v for i, v in enumerate(vignettes) if i in indices]
+        # Create result file.
+        result = ExperimentResult(
+            vignette_file=args.file,
+            vignettes=vignettes,
+            vignette_indices=indices,
+            num_experiments=args.num_experiments,
+            doctor_llm=args.doctor_llm,
+            patient_llm=args.patient_llm,
+            chats=[],
+            comment=args.comment,
+            result_name_suffix=args.result_name_suffix,
+            storage=args.storage,
+        )
+        journal = Journal.create(result)
+    logger.info(f"Journaling every turn to {journal.path}")
 
     # Instantiate correct API clients.
-    doctor_client = model_to_client(args.doctor_llm)
-    patient_client = model_to_client(args.patient_llm)
-
-    # Create result file.
-    result = ExperimentResult(
-        vignette_file=args.file,
-        vignettes=vignettes,
-        vignette_indices=indices,
-        num_experiments=args.num_experiments,
-        doctor_llm=args.doctor_llm,
-        patient_llm=args.patient_llm,
-        chats=[],
-        comment=args.comment,
-        result_name_suffix=args.result_name_suffix,
-    )
-
-    # Run experiment
-    for _ in range(args.num_experiments):
-        simulators = run_experiment(vignettes, doctor_client, patient_client)
-        result.chats.append([s.chat_doctor for s in simulators])
-
-        # Do dump of current results, overwriting at each step.
-        # So partial results are stored even if an error occurs midway in the experiment.
-        logger.info(f"Dumping results to {result.dump_path}")
-        result.dump()
-
-    # Run evaluation
-    result.evaluation = evaluate(result)
-    result.dump()
+    doctor_client = model_to_client(result.doctor_llm)
+    patient_client = model_to_client(result.patient_llm)
+
+    cache = SqliteCache(args.cache) if args.cache else None
+    judge = Judge(
+        model_to_client(args.evaluator_llm),
+        concurrency=args.evaluator_concurrency,
+        batch_size=args.judge_batch_size,
+        cache=cache,
+        matcher=DiagnosisMatcher.from_icd_eval() if args.local_match else None,
+    )
+
+    stop, max_active, path = None, args.max_active_conversations, None
+    if args.target_ci_width is not None:
+        stop = SequentialStop(
+            args.target_ci_width, result.num_experiments, result.vignette_indices, reference
+        )
+        max_active = max_active or TARGET_MAX_ACTIVE
+        # Dropping vignettes changes dump_path, keep the file of the partial dumps.
+        path = result.dump_path
+
+    # Run all experiments, scoring each chat as soon as its conversation finished.
+    result.evaluation = run_experiments(
+        result,
+        doctor_client,
+        patient_client,
+        cache,
+        max_active,
+        journal,
+        score=True,
+        judge=judge,
+        stop=stop,
+    )
+    result.evaluation_config = judge.config
+    journal.close()
+    result.dump(path)
+    # Everything the journal holds is in the result now.
+    journal.discard()
 
 
 if __name__ == "__main__":
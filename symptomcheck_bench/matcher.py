@@ -0,0 +1,123 @@
+import glob
+import json
+import os
+import re
+from collections import Counter, defaultdict
+from logging import getLogger
+from typing import Dict, List, Optional, Set
+
+logger = getLogger("benchmark.matcher")
+
+_PUNCT = re.compile(r"[^\w\s]")
+_PARENTHETICAL = re.compile(r"\(([^)]*)\)")
+_ICD_CODE = re.compile(r"[A-Z]\d\d\.\d+")
+# Parentheticals starting like this qualify the diagnosis instead of naming it.
+_QUALIFIERS = ("including", "e.g", "such", "due", "with", "secondary", "likely", "possibly")
+
+
+def normalize(name: str) -> str:
+    """Case-folded <name> without punctuation, parentheticals and possessives."""
+    name = name.casefold().replace("-", " ").replace("'s", "")
+    name = _PARENTHETICAL.sub(" ", name)
+    name = _PUNCT.sub(" ", name)
+    return " ".join(name.split())
+
+
+def _tokens(name: str) -> Set[str]:
+    """Words of the normalized <name>, with a naive singular, so "stones" is "stone"."""
+    words = normalize(name).split()
+    return {w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w for w in words}
+
+
+def parse_diagnoses(obtained_diagnoses: str) -> Optional[List[str]]:
+    """
+    Split "[A, B (C, D), E]" into ["A", "B (C, D)", "E"]. Return None if the split is
+    ambiguous, like for "Hand, Foot, and Mouth Disease".
+    """
+    inner = obtained_diagnoses.strip().lstrip(":").strip()
+    inner = inner[1:] if inner.startswith("[") else inner
+    inner = inner[:-1] if inner.endswith("]") else inner
+    items, depth, current = [], 0, ""
+    for c in inner:
+        depth += c in "(["
+        depth -= c in ")]"
+        if c == "," and depth == 0:
+            items.append(current)
+            current = ""
+        else:
+            current += c
+    items.append(current)
+    items = [item.strip().strip("\"'") for item in items]
+    if any(not item or item.casefold().startswith(("and ", "or ")) for item in items):
+        return None
+    return items
+
+
+class DiagnosisMatcher:
+    """
+    Local, deterministic matcher of a diagnoses list against the correct diagnosis, to spare
+    the LLM judge the trivial cases. A diagnosis matches if, after normalization, it is the
+    correct diagnosis, has the same words up to order and plurals, or shares its ICD code.
+    Diagnoses also match through their parenthetical, like "Lumbar Radiculopathy (Sciatica)".
+    Only confident verdicts are returned, all other cases are left to the judge. Words are
+    not matched up to typos, which would equate "hypotension" with "hypertension".
+    :param codes: ICD code of each normalized diagnosis name.
+    """
+
+    def __init__(self, codes: Optional[Dict[str, str]] = None) -> None:
+        self.codes = codes or {}
+
+    @classmethod
+    def from_icd_eval(cls, directory: Optional[str] = None) -> "DiagnosisMatcher":
+        """
+        Build the ICD code table from the ICD coding evaluation in <directory>, by default
+        results/icd_eval. Only codes judged an exact match of appropriate specificity are
+        used, and a name gets the code it was most often given.
+        """
+        if directory is None:
+            here = os.path.dirname(os.path.abspath(__file__))
+            directory = os.path.join(here, "results", "icd_eval")
+        votes: Dict[str, Counter] = defaultdict(Counter)
+        for path in glob.glob(os.path.join(directory, "*_icd_eval_results*.jsonl")):
+            with open(path) as f:
+                for line in f:
+                    row = json.loads(line)
+                    code = row.get("provided_icd") or ""
+                    if (
+                        row.get("match_type") == "Exact match"
+                        and row.get("specificity") == "Appropriate specificity"
+                        and _ICD_CODE.fullmatch(code)
+                    ):
+                        votes[normalize(row["example_diagnosis"])][code] += 1
+                        votes[normalize(row["official_diagnosis"])][code] += 1
+        codes = {name: counter.most_common(1)[0][0] for name, counter in votes.items()}
+        logger.info(f"Loaded ICD codes of {len(codes)} diagnoses from {directory}")
+        return cls(codes)
+
+    def _names_match(self, a: str, b: str) -> bool:
+        if normalize(a) == normalize(b):
+            return True
+        tokens_a = _tokens(a)
+        if tokens_a and tokens_a == _tokens(b):
+            return True
+        code_a = self.codes.get(normalize(a))
+        return code_a is not None and code_a == self.codes.get(normalize(b))
+
+    def _matches(self, diagnosis: str, correct_diagnosis: str) -> bool:
+        aliases = [diagnosis] + [
+            inner
+            for inner in _PARENTHETICAL.findall(diagnosis)
+            if not inner.strip().casefold().startswith(_QUALIFIERS)
+        ]
+        return any(self._names_match(alias, correct_diagnosis) for alias in aliases)
+
+    def match(self, obtained_diagnoses: str, correct_diagnosis: str) -> Optional[int]:
+        """
+        1 if the first of <obtained_diagnoses> is <correct_diagnosis>. None if the judge has
+        to decide: a diagnosis before a later match can still be extremely relevant to the
+        judge, like "Dementia" for "Alzheimer's disease", and so can one when nothing matches.
+        """
+        diagnoses = parse_diagnoses(obtained_diagnoses)
+        if diagnoses and self._matches(diagnoses[0], correct_diagnosis):
+            return 1
+        return None
@@ -0,0 +1,97 @@
+import asyncio
+from logging import getLogger
+from typing import TYPE_CHECKING, Callable, List, Optional
+
+from medask.util.rate_limit import rate_limiters
+
+if TYPE_CHECKING:
+    from medask.benchmark.simulator import Simulator
+
+logger = getLogger("benchmark.scheduler")
+
+
+class TurnScheduler:
+    """
+    Run the simulations of many experiments at once on a single event loop.
+    A conversation is a sequence of turns, each an infer_patient or infer_doctor call. Every
+    turn waits in the ready queue of the backend it calls - the FIFO waiters of that
+    backend's AIMDLimiter - and runs once that backend has a free slot. A conversation
+    holds nothing while waiting, so a slow doctor backend never holds back the patient
+    turns of other conversations and every backend is kept saturated at once.
+    :param max_active: Maximum number of conversations in progress at once. The rest are
+        started as others finish. None starts all of them right away.
+    :param report_every: Log the load of each backend every <report_every> seconds.
+    """
+
+    def __init__(self, max_active: Optional[int] = None, report_every: float = 30.0) -> None:
+        self.max_active = max_active
+        self.report_every = report_every
+
+    def _report(self) -> None:
+        for limiter in rate_limiters():
+            c = limiter.concurrency
+            if c.in_flight or c.waiting:
+                logger.info(f"{limiter.name}: {c.in_flight}/{c.limit} in flight, {c.waiting} ready")
+
+    async def _reporter(self) -> None:
+        while True:
+            await asyncio.sleep(self.report_every)
+            self._report()
+
+    async def run(
+        self,
+        groups: List[List["Simulator"]],
+        on_group_done: Optional[Callable[[int], None]] = None,
+        on_done: Optional[Callable[[int, "Simulator"], None]] = None,
+        should_start: Optional[Callable[[int, "Simulator"], bool]] = None,
+        interleave: bool = False,
+    ) -> None:
+        """
+        Simulate all conversations of <groups>, usually one group per experiment.
+        :param on_done: Called with the index of the group and the simulator once a single
+            simulation finished.
+        :param on_group_done: Called with the index of a group once all its simulations
+            finished, for example to store its results.
+        :param should_start: Called with the index of the group and the simulator when a
+            simulation is admitted. If it returns False, the simulation is skipped, and
+            on_done is not called for it.
+        :param interleave: Admit the simulations round-robin over the groups, the first
+            simulation of every group before the second of any, instead of group by group.
+        """
+        total = sum(len(group) for group in groups)
+        semaphore = asyncio.Semaphore(self.max_active or total or 1)
+        left = [len(group) for group in groups]
+
+        async def _simulate(i: int, simulator: "Simulator") -> None:
+            async with semaphore:
+                started = should_start is None or should_start(i, simulator)
+                if started:
+                    await simulator.asimulate()
+            if started and on_done is not None:
+                on_done(i, simulator)
+            left[i] -= 1
+            if left[i] == 0 and on_group_done is not None:
+                on_group_done(i)
+
+        if on_group_done is not None:
+            for i, group in enumerate(groups):
+                if not group:
+                    on_group_done(i)
+
+        # The semaphore admits waiters in order, so this is the order simulations start in.
+        if interleave:
+            order = [
+                (i, group[j])
+                for j in range(max((len(group) for group in groups), default=0))
+                for i, group in enumerate(groups)
+                if j < len(group)
+            ]
+        else:
+            order = [(i, s) for i, group in enumerate(groups) for s in group]
+
+        reporter = asyncio.create_task(self._reporter())
+        try:
+            await asyncio.gather(*(_simulate(i, s) for i, s in order))
+        finally:
+            reporter.cancel()
+        self._report()
@@ -0,0 +1,110 @@
+from typing import Dict, List, Optional, Tuple
+
+from medask.util.bootstrap import Interval, bootstrap_difference, bootstrap_ratio
+
+from medask.benchmark.lazy_result import LazyExperimentResult
+
+# Intervals of fewer vignettes are too unreliable to stop on, e.g. 0 wide if all are correct.
+MIN_VIGNETTES = 20
+
+
+def reference_hits(path: str, k: int = 5) -> Tuple[str, Dict[int, Tuple[int, int]]]:
+    """
+    Top-<k> hits of the evaluated result in <path>, a file or a sharded directory.
+    :return: The vignette file of the result, and for each vignette index in that file,
+        the number of chats with the correct diagnosis in the top <k> and the number of chats.
+    """
+    with LazyExperimentResult(path) as reference:
+        evaluation = reference.evaluation
+        if not evaluation:
+            raise ValueError(f"Reference result {path} is not evaluated")
+        hits = {}
+        for j, vignette_index in enumerate(reference.vignette_indices):
+            positions = [e["positions"][j] for e in evaluation.values()]
+            hits[vignette_index] = (sum(1 <= p <= k for p in positions), len(positions))
+        return reference.vignette_file, hits
+
+
+class SequentialStop:
+    """
+    Decide when enough vignettes are scored to know top-<k> accuracy precisely enough: once
+    the 95% bootstrap interval of the accuracy, or of its difference from a <reference>
+    result, is at most <target_width> wide. A vignette counts once the chats of all its
+    <num_experiments> experiments are scored, and is resampled with all of them.
+    :param vignette_indices: Index in the vignette file of each vignette of the run.
+    :param reference: Top-<k> hits and number of chats by vignette index, from
+        reference_hits(). The difference is paired on the vignettes run in both.
+    """
+
+    def __init__(
+        self,
+        target_width: float,
+        num_experiments: int,
+        vignette_indices: List[int],
+        reference: Optional[Dict[int, Tuple[int, int]]] = None,
+        k: int = 5,
+        min_vignettes: int = MIN_VIGNETTES,
+    ) -> None:
+        self.target_width = target_width
+        self.num_experiments = num_experiments
+        self.vignette_indices = vignette_indices
+        self.reference = reference
+        self.k = k
+        self.min_vignettes = min_vignettes
+        # Top-k hits and scored chats of each vignette, by position in the run.
+        self._scores: Dict[int, List[int]] = {}
+        self._complete: List[int] = []
+        self._interval: Optional[Interval] = None
+
+    def add(self, vignette: int, position: float) -> None:
+        """Record the <position> of the correct diagnosis in a chat of <vignette>."""
+        hits, n = self._scores.setdefault(vignette, [0, 0])
+        self._scores[vignette] = [hits + (1 <= position <= self.k), n + 1]
+        if n + 1 == self.num_experiments:
+            self._complete.append(vignette)
+            self._interval = None
+
+    @property
+    def n_complete(self) -> int:
+        return len(self._complete)
+
+    @property
+    def interval(self) -> Optional[Interval]:
+        """Interval of the accuracy, or of the difference B - A from the reference A."""
+        if self._interval is None and self._complete:
+            vignettes = self._complete
+            if self.reference is not None:
+                vignettes = [j for j in vignettes if self.vignette_indices[j] in self.reference]
+                if not vignettes:
+                    return None
+                ref = [self.reference[self.vignette_indices[j]] for j in vignettes]
+                self._interval = bootstrap_difference(
+                    [hits for hits, _ in ref],
+                    [self._scores[j][0] for j in vignettes],
+                    [n for _, n in ref],
+                    [self._scores[j][1] for j in vignettes],
+                )
+            else:
+                self._interval = bootstrap_ratio(
+                    [self._scores[j][0] for j in vignettes],
+                    [self._scores[j][1] for j in vignettes],
+                )
+        return self._interval
+
+    def reached(self) -> bool:
+        if self.n_complete < self.min_vignettes or self.interval is None:
+            return False
+        _, low, high = self.interval
+        return high - low <= self.target_width
+
+    def summary(self) -> str:
+        what = f"top-{self.k} accuracy"
+        if self.reference is not None:
+            what += " difference from the reference"
+        if self.interval is None:
+            return f"{what}: no vignette scored yet"
+        estimate, low, high = self.interval
+        return (
+            f"{what}: {estimate:.2%}, 95% CI {low:.2%}–{high:.2%}, "
+            f"{high - low:.2%} wide for a target of {self.target_width:.2%}"
+        )
@@ -1,6 +1,7 @@
 import json
 from abc import abstractmethod
 from logging import getLogger
+from typing import Callable, Optional
 
 from medask.models.comms.models import CChat, CMessage
 from medask.models.orm.models import Role
@@ -15,6 +16,12 @@ from medask.benchmark.vignette import Vignette
 logger = getLogger("benchmark.simulator")
 
 
+def diagnosis_complete(text: str) -> bool:
+    """True once <text> contains a closed 'DIAGNOSIS READY: [...]' list."""
+    _, found, rest = text.partition("DIAGNOSIS READY")
+    return bool(found) and "]" in rest
+
+
 class Simulator:
     def __init__(
         self, vignette: "Vignette", doctor_client: "LLMClient", patient_client: "LLMClient"
@@ -25,6 +32,8 @@ class Simulator:
         self.doctor = Doctor(vignette)
         patient = Patient(vignette)
         self.max_len = 24
+        # Called after each turn, e.g. to checkpoint the chats.
+        self.on_turn: Optional[Callable[[], None]] = None
         user_id = 5
         self.chat_doctor = CChat(
             user_id=user_id,
@@ -56,6 +65,16 @@ class Simulator:
         """
         pass
 
+    @abstractmethod
+    async def ainfer_doctor(self) -> CMessage:
+        """Async version of self.infer_doctor()."""
+        pass
+
+    @abstractmethod
+    async def ainfer_patient(self) -> CMessage:
+        """Async version of self.infer_patient()."""
+        pass
+
     @property
     @abstractmethod
     def diagnosis_finished(self) -> bool:
@@ -78,6 +97,40 @@ class Simulator:
     def correct_diagnosis(self) -> str:
         return self.vignette.correct_diagnosis
 
+    @property
+    def finished(self) -> bool:
+        """True if the diagnosis is finished or the chat got too long."""
+        return self.diagnosis_finished or len(self.chat_patient) > self.max_len
+
+    def add_patient_output(self, out_patient: CMessage) -> None:
+        """Append <out_patient> to both the chat_patient and chat_doctor."""
+        # Patient output has role ASSISTANT. The role needs to be changed to USER
+        # before adding it to self.chat_doctor, to simulate what a user would say.
+        out_doctor = self.chat_doctor.messages[-1]
+        prompt_doctor = gen_cmsg(out_doctor, role=Role.USER, body=out_patient.body)
+        self.chat_patient.messages.append(out_patient)
+        self.chat_doctor.messages.append(prompt_doctor)
+
+    def add_doctor_output(self, out_doctor: CMessage) -> None:
+        """Append <out_doctor> to both the chat_doctor and chat_patient."""
+        # Doctor output has role ASSISTANT. The role needs to be changed to USER
+        # before adding it to self.chat_patient, to simulate what a user would say.
+        out_patient = self.chat_patient.messages[-1]
+        prompt_patient = gen_cmsg(out_patient, role=Role.USER, body=out_doctor.body)
+        self.chat_doctor.messages.append(out_doctor)
+        self.chat_patient.messages.append(prompt_patient)
+
+    def set_chat_ids(self) -> None:
+        """Set chat id from generated messages."""
+        if chat_id := self.chat_patient.messages[-1].chat_id:
+            self.chat_patient.id = chat_id
+            for msg in self.chat_patient.messages:
+                msg.chat_id = chat_id
+        if chat_id := self.chat_doctor.messages[-1].chat_id:
+            self.chat_doctor.id = chat_id
+            for msg in self.chat_doctor.messages:
+                msg.chat_id = chat_id
+
     @timeit(logger, log_kwargs=False)
     def simulate(self) -> None:
         """
@@ -89,41 +142,41 @@ class Simulator:
             iv) Append it to both the chat_doctor and chat_patient
         Stop when the diagnosis is finished or too long.
         """
-        out_doctor = self.chat_doctor.messages[-1]
         try:
             while True:
-                out_patient = self.infer_patient()
-                # Patient output has role ASSISTANT. The role needs to be changed to USER
-                # before adding it to self.chat_doctor, to simulate what a user would say.
-                prompt_doctor = gen_cmsg(out_doctor, role=Role.USER, body=out_patient.body)
-                self.chat_patient.messages.append(out_patient)
-                self.chat_doctor.messages.append(prompt_doctor)
-
-                out_doctor = self.infer_doctor()
-                # Doctor output has role ASSISTANT. The role needs to be changed to USER
-                # before adding it to self.chat_patient, to simulate what a user would say.
-                prompt_patient = gen_cmsg(out_patient, role=Role.USER, body=out_doctor.body)
-                self.chat_doctor.messages.append(out_doctor)
-                self.chat_patient.messages.append(prompt_patient)
-
-                if self.diagnosis_finished or len(self.chat_patient) > self.max_len:
+                self.add_patient_output(self.infer_patient())
+                self.add_doctor_output(self.infer_doctor())
+                if self.on_turn is not None:
+                    self.on_turn()
+                if self.finished:
                     break
         except Exception:
             logger.exception(f"Error while simulating vignette {self.vignette}")
 
-        # Set chat id from generated messages.
-        if chat_id := self.chat_patient.messages[-1].chat_id:
-            self.chat_patient.id = chat_id
-            for msg in self.chat_patient.messages:
-                msg.chat_id = chat_id
-        if chat_id := self.chat_doctor.messages[-1].chat_id:
-            self.chat_doctor.id = chat_id
-            for msg in self.chat_doctor.messages:
-                msg.chat_id = chat_id
+        self.set_chat_ids()
+
+    @timeit(logger, log_kwargs=False)
+    async def asimulate(self) -> None:
+        """
+        Async version of self.simulate(), so many simulations can share one event loop.
+        """
+        try:
+            while True:
+                self.add_patient_output(await self.ainfer_patient())
+                self.add_doctor_output(await self.ainfer_doctor())
+                if self.on_turn is not None:
+                    self.on_turn()
+                if self.finished:
+                    break
+        except Exception:
+            logger.exception(f"Error while simulating vignette {self.vignette}")
+
+        self.set_chat_ids()
 
 
 class NaiveSimulator(Simulator):
-    def infer_doctor(self) -> CMessage:
+    def _force_diagnosis(self) -> None:
+        """Instruct the doctor to finish, if the chat is about to get too long."""
         if len(self.chat_doctor.messages) >= self.max_len - 4:
             last = self.chat_doctor.messages[-1]
             new = gen_cmsg(
@@ -132,11 +185,24 @@ class NaiveSimulator(Simulator):
                 body="Immediately finish the conversation by listing the most likely diagnoses.",
             )
             self.chat_doctor.messages.append(new)
+
+    def infer_doctor(self) -> CMessage:
+        self._force_diagnosis()
         return self.doctor_client.converse(self.chat_doctor.messages)
 
     def infer_patient(self) -> CMessage:
         return self.patient_client.converse(self.chat_patient.messages)
 
+    async def ainfer_doctor(self) -> CMessage:
+        self._force_diagnosis()
+        # Everything after the diagnoses list is ignored, so stop generating there.
+        return await self.doctor_client.aconverse_until(
+            self.chat_doctor.messages, stop=diagnosis_complete
+        )
+
+    async def ainfer_patient(self) -> CMessage:
+        return await self.patient_client.aconverse(self.chat_patient.messages)
+
     @property
     def diagnosis_finished(self) -> bool:
         chat = self.chat_doctor
@@ -151,7 +217,7 @@ class NaiveSimulator(Simulator):
 
 
 class LocalSimulator(NaiveSimulator):
-    def infer_doctor(self) -> CMessage:
+    def _doctor_prompt(self) -> CMessage:
         m, _ = marshal(self.chat_doctor.messages, rename_roles=True)
         # In the local server, the INSSS breaks the body into prompt and instruction.
         if len(self.chat_doctor.messages) < 15:
@@ -168,7 +234,14 @@ class LocalSimulator(NaiveSimulator):
             DIAGNOSIS READY: [diagnosis1, diagnosis2, diagnosis3, diagnosis4, diagnosis5]
             """
             )
-        cmsg = CMessage(user_id=1, role=Role.USER, body=m)
-        o = self.doctor_client.inquire(cmsg)
+        return CMessage(user_id=1, role=Role.USER, body=m)
+
+    def infer_doctor(self) -> CMessage:
+        o = self.doctor_client.inquire(self._doctor_prompt())
+        o.body.replace("Response:\n", "")
+        return o
+
+    async def ainfer_doctor(self) -> CMessage:
+        o = await self.doctor_client.ainquire(self._doctor_prompt())
         o.body.replace("Response:\n", "")
         return o
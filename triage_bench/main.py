@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 import datetime
@@ -6,12 +7,16 @@ import sys
 import argparse
 import re
 from collections import Counter
+from math import comb
 
 from tqdm import tqdm
 
 # ───── LLM client imports (keep your project paths) ────────
 from medask.ummon.openai import UmmonOpenAI
 from medask.ummon.deepseek import UmmonDeepSeek
+from medask.ummon.cached import UmmonCached
+from medask.util.bootstrap import bootstrap_ratios
+from medask.util.cache import SqliteCache
 from medask.models.comms.models import CMessage
 from medask.models.orm.models import Role
 # ───────────────────────────────────────────────────────────
@@ -23,6 +28,14 @@ handler.setLevel(logging.INFO)
 handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
 logger.addHandler(handler)
 
+OPENAI_MODELS = ["o1", "o1-mini", "o3", "o3-mini", "o4-mini", "gpt-4o", "gpt-4.5-preview"]
+DEEPSEEK_MODELS = ["deepseek-chat", "deepseek-reasoner"]
+MODELS = OPENAI_MODELS + DEEPSEEK_MODELS
+PROVIDERS = ["openai", "deepseek"]
+VIGNETTE_SETS = ["semigran", "kopka"]
+# Models returning logprobs; the reasoning models don't.
+LOGPROB_MODELS = ["gpt-4o", "gpt-4.5-preview", "deepseek-chat"]
+
 TRIAGE_ORDER = {"sc": 1, "ne": 2, "em": 3}
 TRIAGE_LEVELS = ["em", "ne", "sc"]
 
@@ -45,16 +58,114 @@ Vignette:
 {vignette}
 """
 
+BATCH_PROMPT = """
+Please give a triage classification for each of the following vignettes.
+The criteria for triage classifications are presented below:
+Emergency (em): Call 911 or go directly to the emergency room;
+Non-Emergency (ne): Try to see a doctor, but the symptoms do not require immediate attention at an emergency room. For example, you can see a doctor in the next week.
+Self-care (sc): Let the health issue get better on its own and review the situation in a few days again.
+
+RESPONSE FORMAT:
+    Provide only a JSON object mapping each case id to one of `em`, `ne` or `sc`,
+    like {{"1": "em", "2": "sc"}}.
+
+{cases}
+"""
+
+LOGPROB_PROMPT = """
+Please give a triage classification for the following vignette.
+The criteria for triage classifications are presented below:
+Emergency (em): Call 911 or go directly to the emergency room;
+Non-Emergency (ne): Try to see a doctor, but the symptoms do not require immediate attention at an emergency room. For example, you can see a doctor in the next week.
+Self-care (sc): Let the health issue get better on its own and review the situation in a few days again.
+
+RESPONSE FORMAT:
+    Reply with the code alone, em, ne or sc, without quotes, backticks or any other text.
+
+Vignette:
+{vignette}
+"""
+
 # ───────────────────────── Helper ──────────────────────────
 
-def _llm_triage(client, vignette_text: str) -> str:
-    prompt = ACTIVE_PROMPT.format(vignette=vignette_text)
-    raw = client.inquire(CMessage(user_id=1, body=prompt, role=Role.USER)).body
+def _provider(model: str) -> str:
+    return "openai" if model in OPENAI_MODELS else "deepseek"
+
+
+def _parse_triage(raw: str) -> str:
     cleaned = re.sub(r"[`\s]", " ", raw.lower()).strip()
     match = re.search(r"\b(em|ne|sc)\b", cleaned)
     return match.group(1) if match else cleaned[:50]
 
 
+def _llm_triage(client, vignette_text: str) -> str:
+    prompt = ACTIVE_PROMPT.format(vignette=vignette_text)
+    raw = client.inquire(CMessage(user_id=1, body=prompt, role=Role.USER)).body
+    return _parse_triage(raw)
+
+
+async def _allm_triage(client, vignette_text: str) -> str:
+    prompt = ACTIVE_PROMPT.format(vignette=vignette_text)
+    raw = (await client.ainquire(CMessage(user_id=1, body=prompt, role=Role.USER))).body
+    return _parse_triage(raw)
+
+
+def _parse_batch_triage(raw: str, case_ids: list) -> dict:
+    """Valid labels in the batched reply <raw>, by case id. Missing or invalid ones are left out."""
+    match = re.search(r"\{.*\}", raw, re.DOTALL)
+    try:
+        labels = json.loads(match.group()) if match else {}
+    except json.JSONDecodeError:
+        labels = {}
+    if not isinstance(labels, dict):
+        return {}
+    valid = {}
+    for case_id in case_ids:
+        label = labels.get(str(case_id))
+        if isinstance(label, str) and label.strip().strip("`").lower() in TRIAGE_ORDER:
+            valid[case_id] = label.strip().strip("`").lower()
+    return valid
+
+
+async def _allm_triage_batch(client, vignettes: dict) -> dict:
+    """Triage the <vignettes>, texts by case id, in one request. Returns the valid labels."""
+    cases = "\n\n".join(f"CASE {case_id}:\n{text}" for case_id, text in vignettes.items())
+    prompt = BATCH_PROMPT.format(cases=cases)
+    try:
+        raw = (await client.ainquire(CMessage(user_id=1, body=prompt, role=Role.USER), json=True)).body
+    except Exception:
+        logger.exception("Batched triage request of %d cases failed", len(vignettes))
+        return {}
+    return _parse_batch_triage(raw, list(vignettes))
+
+
+async def _allm_triage_logprobs(client, vignette_text: str) -> tuple:
+    """
+    Triage from the logprobs of a single generated token. Returns the label with the
+    highest probability and the distribution over labels. If no label is among the top
+    candidate tokens, the case is triaged with a free text reply instead, with no distribution.
+    """
+    prompt = LOGPROB_PROMPT.format(vignette=vignette_text)
+    probs = await client.aclassify(CMessage(user_id=1, body=prompt, role=Role.USER), TRIAGE_LEVELS)
+    if not probs:
+        logger.warning("No triage level among the top tokens, asking for a free text reply")
+        return await _allm_triage(client, vignette_text), None
+    return max(probs, key=probs.get), probs
+
+
+def _record(case_id: int, gold: str, pred: str, run_id: int, model_name: str,
+            batch_size: int = 1) -> dict:
+    return {
+        "run_id": run_id,
+        "case_id": case_id,
+        "true_urgency": gold,
+        "llm_output": pred,
+        "correct": pred == gold,
+        "model": model_name,
+        "batch_size": batch_size,
+    }
+
+
 def evaluate_single(case_id: int,
                     desc: str,
                     gold: str,
@@ -63,34 +174,388 @@ def evaluate_single(case_id: int,
                     client,
                     out_file):
     pred = _llm_triage(client, desc)
-    correct = pred == gold
-    rec = {
-        "run_id": run_id,
-        "case_id": case_id,
-        "true_urgency": gold,
-        "llm_output": pred,
-        "correct": correct,
-        "model": model_name,
-    }
+    rec = _record(case_id, gold, pred, run_id, model_name)
     out_file.write(json.dumps(rec, ensure_ascii=False) + "\n")
     return rec
 
+
+async def aevaluate_single(case_id: int,
+                           desc: str,
+                           gold: str,
+                           run_id: int,
+                           model_name: str,
+                           client) -> dict:
+    """Async version of evaluate_single, returning the record instead of writing it."""
+    pred = await _allm_triage(client, desc)
+    return _record(case_id, gold, pred, run_id, model_name)
+
+
+def _vote_settled(votes: Counter, confidence: float) -> bool:
+    """
+    True once the leading label of <votes> holds the majority of the model's answers with
+    probability <confidence>, under a uniform prior on its share p: P(p > 1/2 | votes).
+    For integer Beta parameters this is P(Binomial(n + 1, 1/2) <= leader votes).
+    """
+    n = sum(votes.values())
+    leader = votes.most_common(1)[0][1]
+    return sum(comb(n + 1, k) for k in range(leader + 1)) / 2 ** (n + 1) >= confidence
+
+
+class TriageSummary:
+    """Counters over all predictions, updated with add() as records come in."""
+
+    def __init__(self):
+        self.total_pred_counter = Counter()      # correct / incorrect
+        self.per_level_total = Counter()         # keyed by triage level – counts **predictions**
+        self.per_level_correct = Counter()
+        self.safe_predictions = 0
+        self.overtriage_errors = 0
+        self.voted_cases = 0
+        self.vote_samples = 0
+        self.model_calls = 0.0
+        # (case_id, correct, safe, over‑triaged) of each prediction, for the intervals.
+        self.rows = []
+
+    def add(self, rec: dict):
+        gold = rec["true_urgency"]
+        pred = rec["llm_output"]
+        if "samples" in rec:
+            self.voted_cases += 1
+            self.vote_samples += rec["samples"]
+        # A vote makes one call per sample, a batch one call for all its cases, and a
+        # logprob triage without a distribution fell back to a second, free text call.
+        calls = rec.get("samples", 1) / rec.get("batch_size", 1)
+        self.model_calls += calls + ("probs" in rec and rec["probs"] is None)
+
+        # Per‑prediction counts (fixed)
+        self.per_level_total[gold] += 1
+        if rec["correct"]:
+            self.per_level_correct[gold] += 1
+            self.total_pred_counter["correct"] += 1
+        else:
+            self.total_pred_counter["incorrect"] += 1
+
+        # Safety / over‑triage on each prediction
+        safe = over = False
+        if pred in TRIAGE_ORDER and gold in TRIAGE_ORDER:
+            safe = TRIAGE_ORDER[pred] >= TRIAGE_ORDER[gold]
+            over = (not rec["correct"]) and TRIAGE_ORDER[pred] > TRIAGE_ORDER[gold]
+        self.safe_predictions += safe
+        self.overtriage_errors += over
+        self.rows.append((rec["case_id"], rec["correct"], safe, over))
+
+    def intervals(self):
+        """
+        95% bootstrap intervals of accuracy, safety and over‑triage rate, resampling
+        vignettes with all their runs.
+        """
+        case_ids, correct, safe, over = zip(*self.rows)
+        ones = [1] * len(correct)
+        incorrect = [not c for c in correct]
+        return bootstrap_ratios([correct, safe, over], [ones, ones, incorrect], clusters=case_ids)
+
+    def print(self):
+        total_preds = sum(self.total_pred_counter.values())
+        n_correct = self.total_pred_counter["correct"]
+        overall_acc = n_correct / total_preds if total_preds else 0.0
+
+        print("\nTriage Evaluation Summary (pooled across runs):")
+        print(f"Total model calls: {round(self.model_calls)}")
+        print(f"Overall Accuracy: {overall_acc:.2%}\t({n_correct} / {total_preds})\n")
+
+        print("Accuracy by Triage Level (all predictions):")
+        for lvl in TRIAGE_LEVELS:
+            preds_lvl = self.per_level_total[lvl]
+            corr_lvl = self.per_level_correct[lvl]
+            acc_lvl = corr_lvl / preds_lvl if preds_lvl else 0.0
+            print(f"  {lvl}: {acc_lvl:.2%}\t({corr_lvl}/{preds_lvl})")
+
+        safe = self.safe_predictions
+        safety_rate = safe / total_preds if total_preds else 0.0
+        incorrect_preds = self.total_pred_counter["incorrect"]
+        over = self.overtriage_errors
+        overtriage_rate = over / incorrect_preds if incorrect_preds else 0.0
+
+        print(f"\nSafety (at‑or‑above correct urgency): {safety_rate:.2%}\t({safe}/{total_preds})")
+        print(f"Inclination to Over‑triage (among incorrect): {overtriage_rate:.2%}\t({over}/{incorrect_preds})")
+        if self.voted_cases:
+            mean_samples = self.vote_samples / self.voted_cases
+            print(f"Samples per voted case: {mean_samples:.2f}\t({self.vote_samples}/{self.voted_cases})")
+        if self.rows:
+            print("\n95% CI (bootstrap over vignettes, runs pooled):")
+            for name, (_, low, high) in zip(["Accuracy", "Safety", "Over‑triage"], self.intervals()):
+                print(f"  {name}: {low:.2%} – {high:.2%}")
+
+
+def load_records(path: str) -> list:
+    """
+    Records already in the result JSONL <path>. A partially written last line, left by an
+    interrupted run, is truncated away so that appending continues on a clean line.
+    """
+    records = []
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    for line in data.split(b"\n"):
+        if line:
+            try:
+                if offset + len(line) == len(data):
+                    raise ValueError("record not terminated by a newline")
+                records.append(json.loads(line))
+            except ValueError as e:
+                if offset + len(line) < len(data):
+                    raise ValueError(f"Corrupt record at byte {offset} of {path}: {e}") from e
+                logger.warning("Truncating torn record at byte %d of %s", offset, path)
+                with open(path, "r+b") as f:
+                    f.truncate(offset)
+        offset += len(line) + 1
+    return records
+
+
+class OrderedWriter:
+    """
+    Writes the records of tasks 0, 1, 2, ... to out_file in that order, whatever the order
+    they complete in. A record is held back until all earlier ones are written; each write
+    is flushed and fsynced, so what is in the file survives a crash.
+    """
+
+    def __init__(self, out_file, summary: TriageSummary):
+        self.out_file = out_file
+        self.summary = summary
+        self._next = 0
+        self._pending = {}
+
+    def put(self, index: int, rec: dict):
+        self._pending[index] = rec
+        if self._next not in self._pending:
+            return
+        while self._next in self._pending:
+            rec = self._pending.pop(self._next)
+            self.out_file.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self.summary.add(rec)
+            self._next += 1
+        self._sync()
+
+    def abort(self):
+        """
+        Write the records held back behind a task that failed, in order, so that a --resume
+        of the file only repeats the tasks that did not complete.
+        """
+        if not self._pending:
+            return
+        for index in sorted(self._pending):
+            rec = self._pending.pop(index)
+            self.out_file.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self.summary.add(rec)
+        self._sync()
+
+    def _sync(self):
+        self.out_file.flush()
+        os.fsync(self.out_file.fileno())
+
+
+def _batches(tasks, batch_size: int):
+    """
+    Split <tasks> into lists of up to <batch_size> consecutive (index, task) pairs of the
+    same model and run, where index is the position of the task among those of its model.
+    """
+    batches = []
+    next_index = Counter()
+    for task in tasks:
+        model_name = task[3]
+        last = batches[-1][-1][1] if batches else None
+        if (last is None or len(batches[-1]) == batch_size
+                or (last[2], last[3], last[4]) != (task[2], task[3], task[4])):
+            batches.append([])
+        batches[-1].append((next_index[model_name], task))
+        next_index[model_name] += 1
+    return batches
+
+
+async def run_concurrently(tasks, concurrency: int, writers: dict, batch_size: int = 1,
+                           vote_confidence: float = None, logprobs: bool = False):
+    """
+    Triage <tasks>, (case_id, vignette, run_id, model_name, client) tuples, with at most
+    <concurrency> calls in flight per provider. The records of each model reach its writer
+    in <writers> in the order of <tasks>.
+    With <batch_size> above 1, up to that many cases of a run are sent in one request, and
+    cases missing or invalid in its reply are triaged again one by one.
+    With <vote_confidence>, the client of each task is a list of clients to sample in turn.
+    The case is triaged by majority vote, stopping as soon as the vote is settled with that
+    confidence, and the record holds the votes and the number of samples used.
+    With <logprobs>, each case is triaged from a single token, and the record holds the
+    probabilities of the triage levels.
+    """
+    semaphores = {provider: asyncio.Semaphore(concurrency) for provider in PROVIDERS}
+    progress = tqdm(total=len(tasks), desc="Triage")
+
+    async def _run_single(index, case_id, v, run_id, model_name, client):
+        async with semaphores[_provider(model_name)]:
+            rec = await aevaluate_single(case_id,
+                                         v["case_description"],
+                                         v["urgency_level"].strip().lower(),
+                                         run_id, model_name, client)
+        writers[model_name].put(index, rec)
+        progress.update(1)
+
+    async def _run_logprobs(index, case_id, v, run_id, model_name, client):
+        async with semaphores[_provider(model_name)]:
+            pred, probs = await _allm_triage_logprobs(client, v["case_description"])
+        rec = _record(case_id, v["urgency_level"].strip().lower(), pred, run_id, model_name)
+        rec["probs"] = probs
+        writers[model_name].put(index, rec)
+        progress.update(1)
+
+    async def _run_vote(index, case_id, v, run_id, model_name, clients):
+        votes = Counter()
+        for client in clients:
+            async with semaphores[_provider(model_name)]:
+                votes[await _allm_triage(client, v["case_description"])] += 1
+            if _vote_settled(votes, vote_confidence):
+                break
+        rec = _record(case_id, v["urgency_level"].strip().lower(), votes.most_common(1)[0][0],
+                      run_id, model_name)
+        rec["votes"] = dict(votes)
+        rec["samples"] = sum(votes.values())
+        writers[model_name].put(index, rec)
+        progress.update(1)
+
+    async def _run_batch(batch):
+        _, (_, _, run_id, model_name, client) = batch[0]
+        texts = {case_id: v["case_description"] for _, (case_id, v, *_) in batch}
+        async with semaphores[_provider(model_name)]:
+            labels = await _allm_triage_batch(client, texts)
+        if len(labels) < len(batch):
+            logger.warning("Triaging %d of %d batched cases again one by one",
+                           len(batch) - len(labels), len(batch))
+        retries = []
+        for index, task in batch:
+            case_id, v = task[0], task[1]
+            if case_id not in labels:
+                retries.append(_run_single(index, *task))
+                continue
+            rec = _record(case_id, v["urgency_level"].strip().lower(), labels[case_id],
+                          run_id, model_name, batch_size=len(batch))
+            writers[model_name].put(index, rec)
+            progress.update(1)
+        await asyncio.gather(*retries)
+
+    coros = []
+    for batch in _batches(tasks, batch_size):
+        if len(batch) > 1:
+            coros.append(_run_batch(batch))
+        elif vote_confidence is not None:
+            coros.append(_run_vote(batch[0][0], *batch[0][1]))
+        elif logprobs:
+            coros.append(_run_logprobs(batch[0][0], *batch[0][1]))
+        else:
+            coros.append(_run_single(batch[0][0], *batch[0][1]))
+    running = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        await asyncio.gather(*running)
+    except BaseException:
+        # Stop the other tasks, and keep what those that completed returned.
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        for writer in writers.values():
+            writer.abort()
+        raise
+    finally:
+        progress.close()
+
 # ───────────────────────── Main ───────────────────────────
 
 
+def _mode(batch_size: int, vote: bool, logprobs: bool) -> str:
+    if logprobs:
+        return "--logprobs"
+    if vote:
+        return "--vote_max_samples"
+    return "--batch_size" if batch_size > 1 else "single case triage"
+
+
+def _check_resume(parser: argparse.ArgumentParser, args, records: list) -> None:
+    """Refuse to append to <records> of --resume what an invocation with other arguments makes."""
+    name = os.path.basename(args.resume)
+    for vignette_set in VIGNETTE_SETS:
+        if vignette_set != args.vignette_set and name.endswith(f"_{vignette_set}_triage.jsonl"):
+            parser.error(f"{args.resume} holds {vignette_set} vignettes, pass "
+                         f"--vignette_set {vignette_set}")
+    if not records:
+        return
+    runs = max(rec["run_id"] for rec in records)
+    if runs > args.runs:
+        parser.error(f"{args.resume} has {runs} runs, pass --runs {runs} or more")
+    batch_size = max(rec.get("batch_size", 1) for rec in records)
+    found = _mode(batch_size,
+                  any("samples" in rec for rec in records),
+                  any("probs" in rec for rec in records))
+    wanted = _mode(args.batch_size, bool(args.vote_max_samples), args.logprobs)
+    if found != wanted:
+        parser.error(f"{args.resume} was made with {found}, not {wanted}")
+    if batch_size > 1 and batch_size != args.batch_size:
+        parser.error(f"{args.resume} was made with --batch_size {batch_size}")
+
+
 def main():
     parser = argparse.ArgumentParser("LLM triage benchmark – paired logging, fixed counters")
-    parser.add_argument("--model", choices=["o1", "o1-mini", "o3", "o3-mini", "o4-mini", "gpt-4o", "gpt-4.5-preview", "deepseek-chat", "deepseek-reasoner"],
-                        default="deepseek-chat")
-    parser.add_argument("--vignette_set", choices=["semigran", "kopka"], default="semigran")
+    parser.add_argument("--model", choices=MODELS, default=None,
+                        help="Model to run, by default deepseek-chat, or the model of --resume")
+    parser.add_argument("--models", type=str, default=None,
+                        help="Comma separated models to run together instead of --model, "
+                             "writing one JSONL per model")
+    parser.add_argument("--vignette_set", choices=VIGNETTE_SETS, default="semigran")
     parser.add_argument("--runs", type=int, default=1, help="How many stochastic passes per vignette")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="Optional SQLite file caching LLM completions, so reruns are free")
+    parser.add_argument("--resume", type=str, default=None,
+                        help="Result JSONL of an interrupted invocation with the same arguments. "
+                             "Only the missing (run, case) records are computed and appended to it")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="Number of vignettes triaged per request, answered as JSON. Cases "
+                             "missing from the reply are triaged again one by one")
+    parser.add_argument("--vote_max_samples", type=int, default=None,
+                        help="Triage each case by majority vote over up to this many samples, "
+                             "stopping early once the vote is settled")
+    parser.add_argument("--vote_confidence", type=float, default=0.9,
+                        help="Probability that the leading label is the model's majority answer "
+                             "at which a vote stops")
+    parser.add_argument("--logprobs", action="store_true",
+                        help=f"Triage from a single token, recording the probability of each "
+                             f"triage level. Supported by {', '.join(LOGPROB_MODELS)}")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Number of triage calls in flight at once per provider. Records are "
+                             "still written in (run, case) order")
     args = parser.parse_args()
 
+    resumed = load_records(args.resume) if args.resume else []
+    if args.resume and args.models:
+        parser.error("--resume continues the JSONL of a single model")
+    resumed_models = {rec["model"] for rec in resumed}
+    if len(resumed_models) > 1:
+        parser.error(f"{args.resume} mixes the models {', '.join(sorted(resumed_models))}")
+    if resumed_models and args.model and args.model not in resumed_models:
+        parser.error(f"{args.resume} holds records of {resumed_models.pop()}, not {args.model}")
+    default_model = resumed_models.pop() if resumed_models else "deepseek-chat"
+    models = args.models.split(",") if args.models else [args.model or default_model]
+    for model in models:
+        if model not in MODELS:
+            parser.error(f"unknown model {model}, choose from {', '.join(MODELS)}")
+    if args.vote_max_samples and args.batch_size > 1:
+        parser.error("--vote_max_samples samples cases one by one, without --batch_size")
+    if args.logprobs and (args.batch_size > 1 or args.vote_max_samples):
+        parser.error("--logprobs triages single cases with one call, without --batch_size or voting")
+    if args.logprobs and not set(models) <= set(LOGPROB_MODELS):
+        parser.error(f"--logprobs is supported by {', '.join(LOGPROB_MODELS)} only")
+    if args.resume:
+        _check_resume(parser, args, resumed)
+
     # Client factory
-    if args.model in {"o1", "o1-mini", "o3", "o3-mini", "o4-mini", "gpt-4o", "gpt-4.5-preview"}:
-        client = UmmonOpenAI(args.model)
-    else:
-        client = UmmonDeepSeek(args.model)
+    clients = {}
+    for model in models:
+        clients[model] = UmmonOpenAI(model) if _provider(model) == "openai" else UmmonDeepSeek(model)
+    cache = SqliteCache(args.cache) if args.cache else None
 
     vignette_fp = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vignettes",
                                f"{args.vignette_set}_vignettes.jsonl")
@@ -102,70 +567,75 @@ def main():
         vignettes = [json.loads(l) for l in f]
     num_cases = len(vignettes)
     logger.info("Loaded %d vignettes", num_cases)
+    if any(rec["case_id"] > num_cases for rec in resumed):
+        parser.error(f"{args.resume} has cases beyond the {num_cases} {args.vignette_set} vignettes")
+
+    summaries = {model: TriageSummary() for model in models}
+    done = set()
+
+    # Output paths
+    out_fps = {}
+    if args.resume:
+        out_fps[models[0]] = args.resume
+        for rec in resumed:
+            key = (rec["run_id"], rec["case_id"], rec["model"])
+            if key in done:
+                continue
+            done.add(key)
+            summaries[models[0]].add(rec)
+        logger.info("Resuming %s, which has %d records", args.resume, len(done))
+    else:
+        ts = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+        out_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+        os.makedirs(out_dir, exist_ok=True)
+        for model in models:
+            out_fps[model] = os.path.join(out_dir, f"{ts}_{model}_{args.vignette_set}_triage.jsonl")
+            logger.info("Writing JSONL to %s", out_fps[model])
 
-    # Output path
-    ts = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
-    out_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
-    os.makedirs(out_dir, exist_ok=True)
-    out_fp = os.path.join(out_dir, f"{ts}_{args.model}_{args.vignette_set}_triage.jsonl")
-    logger.info("Writing JSONL to %s", out_fp)
-
-    # ---------------- Counters (all predictions) ----------------
-    total_pred_counter = Counter()      # correct / incorrect
-    per_level_total = Counter()         # keyed by triage level – counts **predictions**
-    per_level_correct = Counter()
-    safe_predictions = 0
-    overtriage_errors = 0
-
-    with open(out_fp, "w", encoding="utf-8") as f_out:
+    # One task per (model, run, case), in the order they are written.
+    tasks = []
+    for model in models:
         for run in range(1, args.runs + 1):
-            logger.info("Run %d/%d", run, args.runs)
-            for idx, v in tqdm(list(enumerate(vignettes, 1)), desc=f"Run {run}"):
+            # Each run is a new stochastic pass, so it gets its own cache namespace.
+            client = clients[model]
+            run_client = UmmonCached(client, cache, namespace=f"run{run}") if cache else client
+            if args.vote_max_samples:
+                # Every sample of a vote needs its own cache namespace to be a new answer.
+                run_client = [run_client] + [
+                    UmmonCached(client, cache, namespace=f"run{run}-sample{k}") if cache else client
+                    for k in range(1, args.vote_max_samples)
+                ]
+            for idx, v in enumerate(vignettes, 1):
+                if (run, idx, model) not in done:
+                    tasks.append((idx, v, run, model, run_client))
+    if args.resume:
+        logger.info("%d records missing", len(tasks))
+
+    mode = "a" if args.resume else "w"
+    out_files = {model: open(fp, mode, encoding="utf-8") for model, fp in out_fps.items()}
+    try:
+        if (args.concurrency > 1 or len(models) > 1 or args.batch_size > 1
+                or args.vote_max_samples or args.logprobs):
+            writers = {model: OrderedWriter(out_files[model], summaries[model]) for model in models}
+            vote_confidence = args.vote_confidence if args.vote_max_samples else None
+            asyncio.run(run_concurrently(tasks, args.concurrency, writers, args.batch_size,
+                                         vote_confidence, args.logprobs))
+        else:
+            for idx, v, run, model_name, run_client in tqdm(tasks, desc="Triage"):
                 rec = evaluate_single(idx,
                                       v["case_description"],
                                       v["urgency_level"].strip().lower(),
-                                      run, args.model, client, f_out)
-
-                gold = rec["true_urgency"]
-                pred = rec["llm_output"]
-
-                # Per‑prediction counts (fixed)
-                per_level_total[gold] += 1
-                if rec["correct"]:
-                    per_level_correct[gold] += 1
-                    total_pred_counter["correct"] += 1
-                else:
-                    total_pred_counter["incorrect"] += 1
-
-                # Safety / over‑triage on each prediction
-                if pred in TRIAGE_ORDER and gold in TRIAGE_ORDER:
-                    if TRIAGE_ORDER[pred] >= TRIAGE_ORDER[gold]:
-                        safe_predictions += 1
-                    if (not rec["correct"]) and TRIAGE_ORDER[pred] > TRIAGE_ORDER[gold]:
-                        overtriage_errors += 1
+                                      run, model_name, run_client, out_files[model_name])
+                summaries[model_name].add(rec)
+    finally:
+        for f_out in out_files.values():
+            f_out.close()
 
     # ---------------- Report ----------------
-    total_preds = sum(total_pred_counter.values())
-    overall_acc = total_pred_counter["correct"] / total_preds if total_preds else 0.0
-
-    print("\nTriage Evaluation Summary (pooled across runs):")
-    print(f"Total model calls: {total_preds}")
-    print(f"Overall Accuracy: {overall_acc:.2%}\t({total_pred_counter['correct']} / {total_preds})\n")
-
-    print("Accuracy by Triage Level (all predictions):")
-    for lvl in TRIAGE_LEVELS:
-        preds_lvl = per_level_total[lvl]
-        corr_lvl = per_level_correct[lvl]
-        acc_lvl = corr_lvl / preds_lvl if preds_lvl else 0.0
-        print(f"  {lvl}: {acc_lvl:.2%}\t({corr_lvl}/{preds_lvl})")
-
-    safety_rate = safe_predictions / total_preds if total_preds else 0.0
-    incorrect_preds = total_pred_counter["incorrect"]
-    overtriage_rate = overtriage_errors / incorrect_preds if incorrect_preds else 0.0
-
-    print(f"\nSafety (at‑or‑above correct urgency): {safety_rate:.2%}\t({safe_predictions}/{total_preds})")
-    print(f"Inclination to Over‑triage (among incorrect): {overtriage_rate:.2%}\t({overtriage_errors}/{incorrect_preds})")
-
+    for model in models:
+        if len(models) > 1:
+            print(f"\n══════ {model} ══════")
+        summaries[model].print()
 
 if __name__ == "__main__":
     main()
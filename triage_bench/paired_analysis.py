@@ -13,6 +13,17 @@
 # Usage (two files):
 #   python paired_analysis.py results/runA.jsonl results/runB.jsonl
 #
+# Given three or more files (or --table), every file is loaded once into one aligned
+# correctness matrix, models × (run_id, case_id), and the script prints one table with
+#   • accuracy, per‑level accuracy, safety and over‑triage rates per model
+#   • McNemar tests of all model pairs, with multiple‑comparison correction
+#   • Cochran's Q test of equal accuracy across all models
+#   • a confusion matrix (true level × prediction) per model
+# Accuracies and their differences get 95% bootstrap intervals, resampling vignettes
+# with all their runs.
+#
+#   python paired_analysis.py results/*_semigran_triage.jsonl --correction holm
+#
 # If you pooled multiple vignette sets into each file first (e.g. cat >deepseek.jsonl),
 # the pairing still works as long as run_id & case_id stay unique per vignette.
 
@@ -21,10 +32,15 @@ from __future__ import annotations
 import argparse
 import json
 from pathlib import Path
-from typing import Tuple
+from typing import List, Tuple
 
+import numpy as np
 import pandas as pd
+from scipy.stats import binom, chi2
 from statsmodels.stats.contingency_tables import mcnemar
+from statsmodels.stats.multitest import multipletests
+
+from medask.util.bootstrap import bootstrap_difference, cluster_totals, resample_totals
 
 TRIAGE_LEVELS = ["em", "ne", "sc"]
 ORDER = {"sc": 1, "ne": 2, "em": 3}
@@ -71,13 +87,195 @@ def print_accuracy_block(df: pd.DataFrame, label: str):
     print(f"Over‑triage inclination (among incorrect): {otr:.2%}  ({over}/{incorrect})")
 
 
+# ─────────────────────────── N‑way ───────────────────────────
+
+def load_matrix(fps: List[Path]):
+    """
+    Load each file once and align them on the (run_id, case_id) pairs they all share.
+    Returns the model labels, the aligned index, the true levels (n,), and the predictions
+    and correctness as (models × n) arrays.
+    """
+    frames = []
+    for fp in fps:
+        df = load_jsonl(fp).drop_duplicates(["run_id", "case_id"], keep="last")
+        frames.append(df.set_index(["run_id", "case_id"]))
+    common = frames[0].index
+    for df in frames[1:]:
+        common = common.intersection(df.index)
+    if common.empty:
+        raise ValueError(
+            "The files share no common (run_id, case_id) pairs; cannot do paired tests."
+        )
+    common = common.sort_values()
+
+    labels = [str(df.model.iloc[0]) if "model" in df else fp.stem for df, fp in zip(frames, fps)]
+    if len(set(labels)) < len(labels):
+        labels = [fp.stem for fp in fps]
+    truth = frames[0].loc[common, "true_urgency"].to_numpy(str)
+    preds = np.stack([df.loc[common, "llm_output"].to_numpy(str) for df in frames])
+    correct = np.stack([df.loc[common, "correct"].to_numpy(bool) for df in frames])
+    return labels, common, truth, preds, correct
+
+
+def level_index(values: np.ndarray) -> np.ndarray:
+    """Position of each value in TRIAGE_LEVELS, len(TRIAGE_LEVELS) for anything else."""
+    idx = np.full(values.shape, len(TRIAGE_LEVELS))
+    for i, lvl in enumerate(TRIAGE_LEVELS):
+        idx[values == lvl] = i
+    return idx
+
+
+def resampled_accuracy(correct, case_ids, n_resamples: int = 10_000) -> np.ndarray:
+    """Accuracy of each model in bootstrap resamples of the vignettes, (resamples × models)."""
+    totals = cluster_totals(np.vstack([correct, np.ones(correct.shape[1])]), case_ids)
+    samples = resample_totals(totals, n_resamples)
+    return samples[:, :-1] / samples[:, -1:]
+
+
+def per_model_table(labels, truth, preds, correct, resampled=None) -> pd.DataFrame:
+    """Accuracy, per‑level accuracy, safety and over‑triage rate of each model."""
+    true_idx, pred_idx = level_index(truth), level_index(preds)
+    # Urgency of each level index; an invalid prediction is below every level.
+    urgency = np.array([ORDER[lvl] for lvl in TRIAGE_LEVELS] + [0])
+    safe = urgency[pred_idx] >= urgency[true_idx]
+    over = (urgency[pred_idx] > urgency[true_idx]) & ~correct
+    incorrect = (~correct).sum(axis=1)
+
+    table = pd.DataFrame({"n": correct.shape[1], "accuracy": correct.mean(axis=1)}, index=labels)
+    if resampled is not None:
+        table["acc_low"], table["acc_high"] = np.percentile(resampled, [2.5, 97.5], axis=0)
+    for i, lvl in enumerate(TRIAGE_LEVELS):
+        mask = true_idx == i
+        table[f"acc_{lvl}"] = correct[:, mask].mean(axis=1) if mask.any() else np.nan
+    table["safety"] = safe.mean(axis=1)
+    table["over_triage"] = np.divide(
+        over.sum(axis=1), incorrect, out=np.zeros(len(labels)), where=incorrect > 0
+    )
+    return table
+
+
+def pairwise_mcnemar(labels, correct, correction: str, resampled=None) -> pd.DataFrame:
+    """
+    McNemar tests of all model pairs at once: exact binomial below 25 discordant pairs,
+    χ² with continuity correction otherwise, as in the two‑file comparison.
+    """
+    x = correct.astype(np.int64)
+    right_wrong = x @ (1 - x).T  # [a, b]: a right, b wrong
+    a, b = np.triu_indices(len(labels), k=1)
+    n_ab, n_ba = right_wrong[a, b], right_wrong[b, a]
+    discordant = n_ab + n_ba
+
+    exact = discordant < 25
+    p_exact = np.minimum(1.0, 2 * binom.cdf(np.minimum(n_ab, n_ba), discordant, 0.5))
+    stat = (np.abs(n_ab - n_ba) - 1) ** 2 / np.maximum(discordant, 1)
+    p_chi2 = chi2.sf(stat, df=1)
+    pvalue = np.where(exact, p_exact, p_chi2)
+    p_adjusted = multipletests(pvalue, method=correction)[1] if len(pvalue) else pvalue
+
+    accuracy = correct.mean(axis=1)
+    pairs = pd.DataFrame(
+        {
+            "A": np.array(labels)[a],
+            "B": np.array(labels)[b],
+            "A_right_B_wrong": n_ab,
+            "A_wrong_B_right": n_ba,
+            "exact": exact,
+            "p": pvalue,
+            f"p_{correction}": p_adjusted,
+            "diff_B_minus_A": accuracy[b] - accuracy[a],
+        }
+    )
+    if resampled is not None:
+        differences = resampled[:, b] - resampled[:, a]
+        pairs["diff_low"], pairs["diff_high"] = np.percentile(differences, [2.5, 97.5], axis=0)
+    return pairs
+
+
+def cochrans_q(correct) -> Tuple[float, float]:
+    """Cochran's Q statistic and p‑value for equal accuracy of all models."""
+    x = correct.astype(np.int64)
+    k = x.shape[0]
+    per_model, per_row = x.sum(axis=1), x.sum(axis=0)
+    total = x.sum()
+    denominator = k * total - (per_row**2).sum()
+    if denominator == 0:
+        return 0.0, 1.0
+    q = (k - 1) * (k * (per_model**2).sum() - total**2) / denominator
+    return float(q), float(chi2.sf(q, df=k - 1))
+
+
+def confusion_matrices(labels, truth, preds) -> np.ndarray:
+    """Counts of (model, true level, predicted level), with invalid predictions last."""
+    true_idx = np.broadcast_to(level_index(truth), preds.shape)
+    model_idx = np.broadcast_to(np.arange(len(labels))[:, None], preds.shape)
+    counts = np.zeros((len(labels), len(TRIAGE_LEVELS), len(TRIAGE_LEVELS) + 1), dtype=np.int64)
+    np.add.at(counts, (model_idx, true_idx, level_index(preds)), 1)
+    return counts
+
+
+def print_nway(fps: List[Path], correction: str):
+    labels, common, truth, preds, correct = load_matrix(fps)
+    print(f"\n{len(labels)} models, {len(common)} paired (run_id, case_id) rows")
+    # Shared by all models, so the intervals of the differences are paired.
+    resampled = resampled_accuracy(correct, common.get_level_values("case_id"))
+
+    print("\n=== Per model (95% bootstrap CI of accuracy) ===")
+    table = per_model_table(labels, truth, preds, correct, resampled)
+    print(table.to_string(float_format=lambda v: f"{v:.2%}"))
+
+    print(f"\n=== Pairwise McNemar ({correction} correction, 95% bootstrap CI of difference) ===")
+    pairs = pairwise_mcnemar(labels, correct, correction, resampled)
+    print(
+        pairs.to_string(
+            index=False,
+            formatters={
+                "p": "{:.4g}".format,
+                f"p_{correction}": "{:.4g}".format,
+                "diff_B_minus_A": "{:+.2%}".format,
+                "diff_low": "{:+.2%}".format,
+                "diff_high": "{:+.2%}".format,
+            },
+        )
+    )
+
+    q, p = cochrans_q(correct)
+    print(f"\n=== Cochran's Q ===\nQ = {q:.3f}, df = {len(labels) - 1}, p‑value: {p:.4g}")
+
+    print("\n=== Confusion matrices (rows: true level, columns: prediction) ===")
+    columns = TRIAGE_LEVELS + ["other"]
+    for label, counts in zip(labels, confusion_matrices(labels, truth, preds)):
+        print(f"\n{label}")
+        print(pd.DataFrame(counts, index=TRIAGE_LEVELS, columns=columns).to_string())
+
+
 # ─────────────────────────── main ────────────────────────────
 
+
 def main():
-    parser = argparse.ArgumentParser("Paired comparison of two triage JSONL files")
-    parser.add_argument("file_a", type=Path, help="JSONL file for model / prompt A")
-    parser.add_argument("file_b", type=Path, help="JSONL file for model / prompt B")
+    parser = argparse.ArgumentParser("Paired comparison of triage JSONL files")
+    parser.add_argument(
+        "files",
+        type=Path,
+        nargs="+",
+        help="JSONL files, one per model / prompt. Two files get the detailed "
+        "A vs B report, more get the N‑way table",
+    )
+    parser.add_argument(
+        "--table", action="store_true", help="Print the N‑way table for two files too"
+    )
+    parser.add_argument(
+        "--correction",
+        default="holm",
+        help="Multiple‑comparison correction of the pairwise p‑values, any "
+        "statsmodels multipletests method (default: holm)",
+    )
     args = parser.parse_args()
+    if len(args.files) < 2:
+        parser.error("at least two files are needed for a paired comparison")
+    if len(args.files) > 2 or args.table:
+        print_nway(args.files, args.correction)
+        return
+    args.file_a, args.file_b = args.files
 
     dfA = load_jsonl(args.file_a).rename(columns={"llm_output": "pred_A", "correct": "correct_A"})
     dfB = load_jsonl(args.file_b).rename(columns={"llm_output": "pred_B", "correct": "correct_B"})
@@ -111,7 +309,11 @@ def main():
 
     accA = merged.correct_A.mean()
     accB = merged.correct_B.mean()
-    print(f"Accuracy difference (B − A): {(accB-accA):+.2%}")
+    _, low, high = bootstrap_difference(merged.correct_A, merged.correct_B, clusters=merged.case_id)
+    print(
+        f"Accuracy difference (B − A): {(accB - accA):+.2%}   "
+        f"(95% bootstrap CI {low:+.2%} – {high:+.2%})"
+    )
 
 
 if __name__ == "__main__":